@@ -0,0 +1,42 @@
+"""add composite indexes for chat pagination
+
+Revision ID: 20251025_chat_idx
+Revises: 20251020_result_jsonb
+Create Date: 2025-10-25 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '20251025_chat_idx'
+down_revision = '20251020_result_jsonb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    为会话列表（游标分页）和消息历史查询添加复合索引
+    """
+    # get_sessions: WHERE user_id = ? AND last_activity_at < ? ORDER BY last_activity_at DESC
+    op.create_index(
+        'idx_sessions_user_lastact',
+        'chat_sessions',
+        ['user_id', 'last_activity_at']
+    )
+
+    # get_messages: WHERE session_id = ? AND is_deleted = false ORDER BY created_at
+    op.create_index(
+        'idx_messages_session_notdel_created',
+        'chat_messages',
+        ['session_id', 'is_deleted', 'created_at']
+    )
+
+
+def downgrade():
+    """
+    回滚：删除复合索引
+    """
+    op.drop_index('idx_messages_session_notdel_created', table_name='chat_messages')
+    op.drop_index('idx_sessions_user_lastact', table_name='chat_sessions')
@@ -0,0 +1,44 @@
+"""add composite indexes for chat context queries
+
+Revision ID: 20251026_chat_ctx_idx
+Revises: 20251025_chat_idx
+Create Date: 2025-10-26 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '20251026_chat_ctx_idx'
+down_revision = '20251025_chat_idx'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    为LLM上下文构建、摘要和最新助手消息查询添加复合索引
+    """
+    # 上下文构建 / 摘要生成 / 编辑恢复:
+    # WHERE session_id = ? AND is_summarized = ? AND is_deleted = false ORDER BY created_at
+    op.create_index(
+        'idx_messages_session_summarized',
+        'chat_messages',
+        ['session_id', 'is_summarized', 'is_deleted', 'created_at']
+    )
+
+    # _context_tokens_query（edit_message 重算上下文token）:
+    # WHERE session_id = ? AND role = 'assistant' AND is_deleted = false ORDER BY created_at DESC LIMIT 1
+    op.create_index(
+        'idx_messages_session_role_created',
+        'chat_messages',
+        ['session_id', 'role', 'is_deleted', 'created_at']
+    )
+
+
+def downgrade():
+    """
+    回滚：删除复合索引
+    """
+    op.drop_index('idx_messages_session_role_created', table_name='chat_messages')
+    op.drop_index('idx_messages_session_summarized', table_name='chat_messages')
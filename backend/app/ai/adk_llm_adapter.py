@@ -517,9 +517,9 @@ class ADKLlmAdapter(BaseLlm):
                 created_at=datetime.utcnow()
             )
 
-            # 保存到数据库
+            # ✅ 只加入数据库会话、不单独 flush：序号在内存中递增，无需数据库ID，
+            # 随外层的最终 commit 一起写入（流式生成期间不占用连接、不持有会话行锁）
             self.db_session.add(invocation)
-            self.db_session.flush()  # 立即写入，但不提交（由外层控制提交）
 
             LOGGER.info(
                 f"✅ 已保存 ModelInvocation 记录 #{current_sequence}: "
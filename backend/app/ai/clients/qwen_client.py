@@ -30,6 +30,7 @@ class QwenClient(BaseAIClient):
         model: str = "qwen3:8b",  # Default model set to qwen3:8b
         timeout: float = 300.0,  # 增加到5分钟，支持复杂的知识库问答任务
         max_retries: int = 3,
+        keep_alive: Optional[str] = None,
     ):
         """
         初始化Qwen客户端
@@ -39,11 +40,13 @@ class QwenClient(BaseAIClient):
             model: 模型名称
             timeout: 请求超时时间
             max_retries: 最大重试次数
+            keep_alive: 请求后模型在 Ollama 中保持加载的时长（保持加载时可复用相同提示词前缀的KV缓存），None 使用 Ollama 的默认值
         """
         self.base_url = base_url.rstrip("/")
         self.model = model
         self.timeout = timeout
         self.max_retries = max_retries
+        self.keep_alive = keep_alive
         self.client = httpx.AsyncClient(
             timeout=httpx.Timeout(timeout),
             limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
@@ -86,6 +89,9 @@ class QwenClient(BaseAIClient):
         if options:
             data["options"] = options
 
+        if self.keep_alive:
+            data["keep_alive"] = self.keep_alive
+
         if stream:
             return self._stream_generate(url, data)
         else:
@@ -149,6 +155,10 @@ class QwenClient(BaseAIClient):
         if options:
             data["options"] = options
 
+        # ✅ 模型保持加载时，Ollama 会复用与上次请求相同前缀（系统提示词+历史）的KV缓存，省去重复 prefill
+        if self.keep_alive:
+            data["keep_alive"] = self.keep_alive
+
         if stream:
             return self._stream_chat(url, data)
         else:
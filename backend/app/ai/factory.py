@@ -3,6 +3,8 @@
 import logging
 from typing import Dict, Optional
 
+from app.core.config import SETTINGS
+
 from .clients.base import BaseAIClient
 from .clients.qwen_client import QwenClient
 
@@ -77,6 +79,10 @@ class AIClientFactory:
         if base_url:
             client_kwargs["base_url"] = base_url
 
+        # Ollama 模型保持加载时长（配置项，未设置时使用 Ollama 的默认值）
+        if provider == "ollama" and SETTINGS.ollama_keep_alive:
+            client_kwargs["keep_alive"] = SETTINGS.ollama_keep_alive
+
         # 添加其他参数
         client_kwargs.update(kwargs)
 
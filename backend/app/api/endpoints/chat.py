@@ -107,7 +107,8 @@ def get_sessions(
         limit=limit
     )
 
-    # ✅ 为每个会话添加上下文使用信息
+    # ✅ 为每个会话添加上下文使用信息（先批量预热模型配置缓存，避免逐个会话查询模型）
+    chat_service.prefetch_models({session.ai_model or "qwen3:8b" for session in sessions})
     enriched_sessions = [
         chat_service.enrich_session_with_context_info(session)
         for session in sessions
@@ -1,11 +1,11 @@
 """WebSocket端点，处理实时聊天"""
 
 import asyncio
-import json
 import logging
 from typing import Dict
 from uuid import uuid4
 
+import orjson
 from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, status
 from sqlalchemy.orm import Session
 
@@ -63,12 +63,16 @@ class ConnectionManager:
 
         Args:
             user_id: 用户ID
-            message: 消息字典
+            message: 消息字典（event_data 可以是 JSON 字符串或已编码的 JSON bytes）
         """
         if user_id in self.active_connections:
             websocket = self.active_connections[user_id]
             try:
-                await websocket.send_json(message)
+                # ✅ 预编码的 event_data 只在这里解码一次，整帧用 orjson 序列化后以文本帧发送
+                event_data = message.get("event_data")
+                if isinstance(event_data, bytes):
+                    message = {**message, "event_data": event_data.decode()}
+                await websocket.send_text(orjson.dumps(message, default=str).decode())
             except Exception as e:
                 LOGGER.error("向用户 %s 发送消息失败: %s", user_id, str(e))
                 # 发送失败，断开连接
@@ -115,7 +119,7 @@ class ConnectionManager:
         message = {
             "event_type": EventType.DOCUMENT_STATUS_UPDATE,
             "event_id": str(uuid4()),  # 使用UUID作为事件ID
-            "event_data": json.dumps(event_data, ensure_ascii=False)
+            "event_data": orjson.dumps(event_data)
         }
 
         if user_id in self.active_connections:
@@ -216,7 +220,7 @@ async def websocket_chat_endpoint(
             try:
                 # 接收消息
                 data = await websocket.receive_text()
-                message = json.loads(data)
+                message = orjson.loads(data)
                 msg_type = message.get("type")
 
                 # 处理不同类型的消息
@@ -263,7 +267,7 @@ async def websocket_chat_endpoint(
                 else:
                     LOGGER.exception("用户 %s 运行时错误", user_id)
                     break
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 LOGGER.warning("用户 %s 发送了无效的JSON: %s", user_id, data)
                 try:
                     await manager.send_message(user_id, {
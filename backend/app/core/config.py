@@ -186,6 +186,15 @@ class Settings(BaseSettings):
         """Redis是否自动解码响应。"""
         return self._config_data.get("redis", {}).get("decode_responses", True)
 
+    # Ollama配置
+    @property
+    def ollama_keep_alive(self) -> Optional[str]:
+        """请求后模型在 Ollama 中保持加载的时长（如 "30m"），未设置时使用 Ollama 的默认值。
+
+        保持加载会一直占用显存，共享的 Ollama 主机上可能挤掉其他模型，按部署情况设置。
+        """
+        return self._config_data.get("ollama", {}).get("keep_alive")
+
     # 邮件配置
     @property
     def email_host(self) -> str:
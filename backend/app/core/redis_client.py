@@ -1,7 +1,7 @@
 """Redis客户端模块，提供Redis连接和操作。"""
 
 from datetime import timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import json
 import hashlib
 
@@ -385,6 +385,146 @@ class RedisService:
         key = f"session_summary:{session_id}"
         return self.client.delete(key) > 0
 
+    # ==================== 会话LLM上下文缓存 ====================
+    # 同一会话的多轮对话可能重叠（多个标签页/连接），用轮次计数保证只有“独占”的一轮才写回缓存：
+    # - session_turn:{id}   已开始的轮次序号
+    # - session_active:{id} 正在进行的轮次数
+    # 一轮开始时没有其他轮次在进行、结束时也没有新的轮次开始过，它的上下文才与数据库一致，才写回；
+    # 否则删除缓存，下一轮从数据库重建
+
+    def begin_session_turn(
+        self,
+        session_id: str,
+        expire_seconds: int = 7200
+    ) -> tuple[Optional[List[Dict[str, Any]]], int, bool]:
+        """开始一轮对话：取出LLM上下文缓存（读取后立即删除）并登记轮次
+
+        读取即删除，保证中途失败/被中断的对话不会留下过期的上下文，
+        只有成功完成且独占的一轮对话才会重新写入缓存（见 end_session_turn）。
+
+        Args:
+            session_id: 会话ID
+            expire_seconds: 轮次计数的过期时间（秒），兜底清理未正常结束的轮次
+
+        Returns:
+            (OpenAI格式的消息列表或None, 本轮序号, 本轮是否独占（开始时没有其他轮次在进行）)
+        """
+        ctx_key = f"session_ctx:{session_id}"
+        turn_key = f"session_turn:{session_id}"
+        active_key = f"session_active:{session_id}"
+
+        # 事务管道（MULTI/EXEC）：取出缓存和登记轮次原子执行
+        pipe = self.client.pipeline()
+        pipe.get(ctx_key)
+        pipe.delete(ctx_key)
+        pipe.incr(turn_key)
+        pipe.expire(turn_key, expire_seconds)
+        pipe.incr(active_key)
+        pipe.expire(active_key, expire_seconds)
+        cached, _, turn, _, active, _ = pipe.execute()
+
+        exclusive = active == 1
+        if not cached or not exclusive:
+            return None, turn, exclusive
+        return json.loads(cached), turn, exclusive
+
+    def end_session_turn(
+        self,
+        session_id: str,
+        turn: int,
+        messages: Optional[List[Dict[str, Any]]] = None,
+        expire_seconds: int = 7200
+    ) -> bool:
+        """结束一轮对话：期间没有新的轮次开始时写回LLM上下文缓存，否则删除缓存
+
+        使用 Lua 脚本保证“检查轮次序号 + 写入/删除”的原子性
+
+        Args:
+            session_id: 会话ID
+            turn: begin_session_turn 返回的本轮序号
+            messages: 本轮结束后的上下文（None 表示不写回：出错、被中断、非独占或摘要待生效）
+            expire_seconds: 缓存过期时间（秒），默认2小时
+
+        Returns:
+            是否写回了缓存
+        """
+        ctx_key = f"session_ctx:{session_id}"
+        turn_key = f"session_turn:{session_id}"
+        active_key = f"session_active:{session_id}"
+        payload = json.dumps(messages, ensure_ascii=False) if messages is not None else ""
+
+        lua_script = """
+        local active = redis.call('DECR', KEYS[3])
+        if active <= 0 then
+            redis.call('DEL', KEYS[3])
+        end
+        if ARGV[2] ~= '' and redis.call('GET', KEYS[2]) == ARGV[1] then
+            redis.call('SETEX', KEYS[1], ARGV[3], ARGV[2])
+            return 1
+        end
+        redis.call('DEL', KEYS[1])
+        return 0
+        """
+
+        return bool(self.client.eval(
+            lua_script, 3, ctx_key, turn_key, active_key, turn, payload, expire_seconds
+        ))
+
+    def delete_session_context(self, session_id: str) -> bool:
+        """删除会话的LLM上下文缓存（编辑/删除消息、生成摘要时）
+
+        同时推进轮次序号，使正在进行的轮次结束时不再写回基于旧历史的上下文。
+
+        Args:
+            session_id: 会话ID
+
+        Returns:
+            是否删除成功
+        """
+        turn_key = f"session_turn:{session_id}"
+        pipe = self.client.pipeline()
+        pipe.delete(f"session_ctx:{session_id}")
+        pipe.incr(turn_key)
+        pipe.expire(turn_key, 7200)
+        deleted, _, _ = pipe.execute()
+        return deleted > 0
+
+    # ==================== AI模型配置缓存 ====================
+
+    def get_model_config(self, model_id: str) -> Optional[Dict[str, Any]]:
+        """获取AI模型配置缓存
+
+        Args:
+            model_id: 模型ID
+
+        Returns:
+            模型配置字典（空字典表示已缓存为“模型不存在或未激活”），没有缓存返回None
+        """
+        key = f"ai_model:{model_id}"
+        cached = self.client.get(key)
+        if not cached:
+            return None
+        return json.loads(cached)
+
+    def save_model_config(
+        self,
+        model_id: str,
+        config: Dict[str, Any],
+        expire_seconds: int = 60
+    ) -> bool:
+        """保存AI模型配置缓存（没有失效通知，修改模型配置后靠短过期时间生效）
+
+        Args:
+            model_id: 模型ID
+            config: 模型配置字典（空字典表示模型不存在或未激活）
+            expire_seconds: 过期时间（秒），默认60秒
+
+        Returns:
+            是否保存成功
+        """
+        key = f"ai_model:{model_id}"
+        return self.client.setex(key, expire_seconds, json.dumps(config, ensure_ascii=False))
+
     # ==================== API 调用频率限制 ====================
 
     def check_rate_limit(
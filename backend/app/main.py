@@ -12,11 +12,13 @@ os.environ['HF_DATASETS_OFFLINE'] = '1'
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.ai.factory import FACTORY
 from app.api.router import api_router
 from app.core.config import SETTINGS
 from app.core.redis_client import redis_service
 from app.middleware.jwt_middleware import JWTMiddleware
 from app.middleware.rate_limit import RateLimitMiddleware
+from app.services.chat_service import start_title_worker, stop_title_worker
 
 # ============ 配置日志 ============
 # 配置根日志记录器，确保应用程序的日志也能输出
@@ -92,6 +94,9 @@ async def startup_event():
 
     print(f"API文档: http://localhost:8000{SETTINGS.api_v1_str}/docs")
 
+    # 启动会话标题生成后台 worker
+    start_title_worker()
+
     # 初始化RAG模型管理器（单例模式）
     try:
         logging.info("初始化 RAG 模型管理器...")
@@ -117,6 +122,10 @@ async def startup_event():
 async def shutdown_event():
     """应用关闭时的事件处理函数。"""
     print(f"Shutting down {SETTINGS.project_name}...")
+    await stop_title_worker()
+
+    # 关闭缓存的AI客户端（释放 keep-alive 连接池）
+    await FACTORY.close_all()
 
 
 # 健康检查端点
@@ -4,7 +4,7 @@ from datetime import datetime
 from typing import Any, Dict
 import uuid
 
-from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Integer, String, Text
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import relationship
 
@@ -61,6 +61,12 @@ class ChatMessage(BaseModel):
     # 关系
     session = relationship("ChatSession", back_populates="messages")
 
+    __table_args__ = (
+        Index("idx_messages_session_notdel_created", "session_id", "is_deleted", "created_at"),  # 消息历史查询
+        Index("idx_messages_session_summarized", "session_id", "is_summarized", "is_deleted", "created_at"),  # LLM上下文/摘要
+        Index("idx_messages_session_role_created", "session_id", "role", "is_deleted", "created_at"),  # 最新助手消息
+    )
+
     def __repr__(self) -> str:
         """返回消息的字符串表示"""
         return f"<ChatMessage {self.id} role={self.role}>"  # pylint: disable=no-member
@@ -3,7 +3,7 @@
 from typing import Any, Dict, List, TYPE_CHECKING
 import uuid
 
-from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Integer, String, Text
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import relationship
 
@@ -57,6 +57,10 @@ class ChatSession(BaseModel):
                             cascade="all, delete-orphan")
     user = relationship("User", backref="sessions")
 
+    __table_args__ = (
+        Index("idx_sessions_user_lastact", "user_id", "last_activity_at"),  # 会话列表游标分页
+    )
+
     def __repr__(self) -> str:
         """返回会话的字符串表示"""
         return f"<ChatSession {self.title or self.id}>"  # pylint: disable=no-member
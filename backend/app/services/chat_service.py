@@ -1,13 +1,17 @@
 """聊天服务层，处理会话和消息的业务逻辑"""
 
-import json
+import asyncio
 import logging
 import re
+import time
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass
 from datetime import datetime
 from typing import AsyncIterator, Dict, List, Optional, Tuple, Any
 from uuid import uuid4
 
-from sqlalchemy import and_, desc, or_
+import orjson
+from sqlalchemy import and_, desc, func, insert, inspect, or_, update
 from sqlalchemy.orm import Session, attributes
 
 #from app.ai.agent_service import AgentService
@@ -16,6 +20,7 @@ from app.ai.factory import FACTORY
 from app.constants import EventType, ContentType, MessageStatus
 from app.core.prompts import DEFAULT_SYSTEM_PROMPT
 from app.core.redis_client import redis_service
+from app.db.session import SESSION_LOCAL
 from app.models.ai_model import AIModel
 from app.models.chat import ChatMessage
 from app.models.invocation import ToolInvocation
@@ -24,6 +29,409 @@ from app.models.user import User
 
 LOGGER = logging.getLogger(__name__)
 
+# 会话表可更新的列名（用于过滤 update_session 的参数）
+_SESSION_COLUMNS = frozenset(ChatSession.__table__.columns.keys())
+
+
+def _json_str(obj: Any) -> str:
+    """使用 orjson 序列化为 JSON 字符串（UTF-8 原样输出，等价于 ensure_ascii=False）"""
+    return orjson.dumps(obj, default=str).decode()
+
+
+# ✅ 流式增量内容 {"text": ...} 的预编码模板，每个 token 只需编码文本本身
+_TEXT_PREFIX = b'{"text":'
+_TEXT_SUFFIX = b'}'
+
+
+def _text_content(text: str) -> str:
+    """构造增量事件的 {"text": ...} 内容载荷
+
+    Args:
+        text: 增量文本
+
+    Returns:
+        JSON 字符串
+    """
+    return (_TEXT_PREFIX + orjson.dumps(text) + _TEXT_SUFFIX).decode()
+
+
+# ✅ thinking 块标签（流式解析时用 str.find 按偏移查找，不在每个 chunk 上重新跑正则）
+_THINK_OPEN = "<think>"
+_THINK_CLOSE = "</think>"
+_THINK_OPEN_LEN = len(_THINK_OPEN)
+_THINK_CLOSE_LEN = len(_THINK_CLOSE)
+
+def _partial_tag_len(text: str, tag: str) -> int:
+    """计算 text 末尾与 tag 前缀重合的最长长度（标签被拆在两个 chunk 之间时使用）
+
+    Args:
+        text: 待检查的文本
+        tag: 标签，如 "</think>"
+
+    Returns:
+        末尾需要暂缓确认的字符数，0 表示末尾不可能是半个标签
+    """
+    for size in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:size]):
+            return size
+    return 0
+
+
+# ✅ _ThinkTagSplitter 输出的片段类型
+_SEG_CONTENT = 0  # 正文文本
+_SEG_THINKING = 1  # thinking 文本
+_SEG_THINK_OPEN = 2  # 进入 thinking 块（<think>）
+_SEG_THINK_CLOSE = 3  # thinking 块结束（</think>）
+
+
+class _ThinkTagSplitter:
+    """按 <think> / </think> 把流式文本拆分为正文和 thinking 片段
+
+    标签可能被拆在多个 chunk 之间：末尾可能是半个标签的几个字符暂缓确认，留到下一个 chunk 再判断。
+    """
+
+    def __init__(self):
+        self.tail = ""  # 尚未确认的尾部文本（只可能是半个 <think> / </think>）
+        self.in_thinking = False
+
+    def feed(self, text: str) -> List[Tuple[int, str]]:
+        """加入一段流式文本
+
+        Args:
+            text: 新到达的文本
+
+        Returns:
+            已确认的片段列表 [(片段类型, 文本)]，标签片段的文本为空字符串
+        """
+        segments = []
+        tail = self.tail + text
+        while tail:
+            if not self.in_thinking:
+                # 正文模式：查找下一个 <think>
+                pos = tail.find(_THINK_OPEN)
+                if pos == -1:
+                    # ✅ 快速路径：没有 "<" 时末尾不可能是半个 <think>，整段直接确认
+                    hold = _partial_tag_len(tail, _THINK_OPEN) if "<" in tail else 0
+                    confirmed = tail[:len(tail) - hold] if hold else tail
+                    tail = tail[len(tail) - hold:] if hold else ""
+                else:
+                    confirmed = tail[:pos]
+                    tail = tail[pos + _THINK_OPEN_LEN:]
+                if confirmed:
+                    segments.append((_SEG_CONTENT, confirmed))
+                if pos == -1:
+                    break
+                segments.append((_SEG_THINK_OPEN, ""))
+                self.in_thinking = True
+                continue
+
+            # thinking 模式：查找 </think>
+            pos = tail.find(_THINK_CLOSE)
+            if pos == -1:
+                # 未闭合：末尾可能是被拆开的半个 </think>，先留在 tail 中等下一个 chunk
+                hold = _partial_tag_len(tail, _THINK_CLOSE)
+                confirmed = tail[:len(tail) - hold] if hold else tail
+                tail = tail[len(tail) - hold:] if hold else ""
+            else:
+                confirmed = tail[:pos]
+                tail = tail[pos + _THINK_CLOSE_LEN:]
+            if confirmed:
+                segments.append((_SEG_THINKING, confirmed))
+            if pos == -1:
+                break
+            segments.append((_SEG_THINK_CLOSE, ""))
+            self.in_thinking = False
+        self.tail = tail
+        return segments
+
+    def finish(self) -> List[Tuple[int, str]]:
+        """流结束：暂缓确认的末尾字符不再可能构成标签，按当前模式作为正文或 thinking 文本
+
+        Returns:
+            剩余的片段列表（未闭合的 thinking 块不会产生 _SEG_THINK_CLOSE）
+        """
+        tail, self.tail = self.tail, ""
+        if not tail:
+            return []
+        return [(_SEG_THINKING if self.in_thinking else _SEG_CONTENT, tail)]
+
+
+# ✅ 增量事件（MESSAGE_CONTENT / THINKING_DELTA）event_data 的预编码模板
+# 结构：{"message_id":..,"conversation_id":..,"message":{"id":..,"content_type":..,"content":..},
+#        "status":PENDING,"is_delta":true,"message_index":..}
+# 其中 message_id / conversation_id 在每次流式开始时拼入一次（见 _delta_event_prefix）
+_DELTA_TEXT_TYPE = b',"content_type":%d,"content":' % ContentType.TEXT
+_DELTA_THINKING_TYPE = b',"content_type":%d,"content":' % ContentType.THINKING
+_DELTA_SUFFIX = b'},"status":%d,"is_delta":true,"message_index":' % MessageStatus.PENDING
+
+
+def _delta_event_prefix(message_id: str, conversation_id: str) -> bytes:
+    """构造单次流式回复内固定不变的增量事件前缀
+
+    Args:
+        message_id: 助手消息ID
+        conversation_id: 会话ID
+
+    Returns:
+        event_data 前缀 bytes（到 message.id 的值之前）
+    """
+    return (
+        b'{"message_id":' + orjson.dumps(message_id)
+        + b',"conversation_id":' + orjson.dumps(conversation_id)
+        + b',"message":{"id":'
+    )
+
+
+def _delta_event_data(prefix: bytes, block_id: str, is_thinking: bool, text: str, message_index: int) -> bytes:
+    """按模板拼接增量事件的 event_data，只编码变化的字段
+
+    Args:
+        prefix: _delta_event_prefix 生成的前缀
+        block_id: message.id
+        is_thinking: 是否为 thinking 增量
+        text: 增量文本
+        message_index: 消息序号
+
+    Returns:
+        event_data 的 JSON bytes
+    """
+    return b"".join((
+        prefix,
+        orjson.dumps(block_id),
+        _DELTA_THINKING_TYPE if is_thinking else _DELTA_TEXT_TYPE,
+        orjson.dumps(_text_content(text)),  # ✅ content 本身是 JSON 字符串
+        _DELTA_SUFFIX,
+        b"%d}" % message_index,
+    ))
+
+
+# ✅ 固定不变的 thinking 状态内容，模块加载时编码一次
+_THINKING_START_CONTENT = _json_str({"finish_title": "深度思考中"})  # ✅ 对齐业界标准
+_THINKING_COMPLETE_CONTENT = _json_str({"finish_title": "已完成思考"})
+
+# ✅ 流式热路径使用的事件/内容类型，模块加载时绑定一次
+_EV_CONTENT = EventType.MESSAGE_CONTENT
+_EV_THINKING_DELTA = EventType.THINKING_DELTA
+
+# ✅ LLM 生成标题时可能带上的"标题："前缀（一次匹配全角/半角冒号及其后空白）
+_TITLE_PREFIX_RE = re.compile(r'^标题\s*[：:]\s*')
+# ✅ 标题提示词中使用的对话片段长度，及换行/制表符 → 空格的转换表
+_TITLE_USER_CHARS = 200
+_TITLE_ASSISTANT_CHARS = 300
+_TITLE_WS_TABLE = str.maketrans('\n\r\t', '   ')
+
+
+# ✅ 粗略估算 token 数：中日韩字符约 1 token/字，其余文本约 4 字符/token（中文没有空格，不能按 split() 估算）
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+
+
+def _estimate_tokens(text: str) -> int:
+    """估算文本的 token 数（无 LLM 返回的 usage 统计时使用）
+
+    Args:
+        text: 文本
+
+    Returns:
+        估算的 token 数
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+# ✅ 构建LLM上下文（_build_llm_messages）需要的消息列
+_LLM_CONTEXT_COLUMNS = (
+    ChatMessage.role,
+    ChatMessage.content,
+    ChatMessage.tool_calls,
+    ChatMessage.tool_call_id,
+    ChatMessage.name,
+    ChatMessage.is_internal,
+    ChatMessage.is_summary,
+)
+
+
+@dataclass(frozen=True)
+class ModelConfig:
+    """模型配置快照（get_model_by_id 的返回值，可跨请求缓存）"""
+
+    model_id: str
+    provider: str
+    base_url: str
+    max_tokens: Optional[int]
+    max_context_length: Optional[int]
+    supports_streaming: bool
+    supports_tools: bool
+
+
+# ✅ 模型配置进程内缓存：{model_id: (过期时刻 time.monotonic(), ModelConfig 或 None)}
+# 模型配置很少变化，每轮对话无需再查询数据库；Redis 缓存使用相同的过期时间，
+# 修改或停用模型后最多约 2 * _MODEL_CACHE_TTL 秒生效（Redis 缓存过期 + 进程内缓存过期）
+# 不存在或未激活的模型缓存为 None（负缓存），过期时间更短，新增/启用模型后约 2 * _MODEL_MISS_TTL 秒生效
+_MODEL_CACHE: Dict[str, Tuple[float, Optional[ModelConfig]]] = {}
+_MODEL_CACHE_TTL = 60.0
+_MODEL_MISS_TTL = 10.0
+
+# ✅ 进程内用户系统提示词缓存：{user_id: (写入时刻, 系统提示词)}，位于 Redis 用户偏好缓存之前
+_SYSTEM_PROMPT_CACHE: Dict[str, Tuple[float, str]] = {}
+_SYSTEM_PROMPT_CACHE_TTL = 60.0
+
+
+class _DeltaCoalescer:
+    """合并连续的同类增量文本（MESSAGE_CONTENT / THINKING_DELTA），减少 WebSocket 帧数
+
+    增量先进入缓冲区，满足以下任一条件时合并为一帧发出：
+    - 距上次发出超过 window 秒（新增量到达时判断；上游暂停时由 _iter_with_flush_deadline 到期唤醒调用方 flush）
+    - 缓冲文本达到 max_chars 个字符
+    - 增量类型或所属块变化
+    其他事件（thinking 开始/完成、工具调用等）发出前由调用方先 flush，保证事件顺序不变。
+    """
+
+    def __init__(self, window: float = 0.02, max_chars: int = 256):
+        self.window = window
+        self.max_chars = max_chars
+        self.event_type: Optional[int] = None
+        self.block_id: Optional[str] = None
+        self.parts: List[str] = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+    def push(self, event_type: int, block_id: Optional[str], text: str) -> List[Tuple[int, Optional[str], str]]:
+        """加入一段增量文本
+
+        Args:
+            event_type: 增量事件类型
+            block_id: 所属块ID（thinking 块ID，正文为 None）
+            text: 增量文本
+
+        Returns:
+            需要立即发出的批次列表 [(event_type, block_id, text)]
+        """
+        batches = []
+        if self.parts and (event_type != self.event_type or block_id != self.block_id):
+            batches.append(self.flush())
+        self.event_type = event_type
+        self.block_id = block_id
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.max_chars or time.monotonic() - self.last_flush >= self.window:
+            batches.append(self.flush())
+        return batches
+
+    def time_left(self) -> Optional[float]:
+        """距离缓冲区到期还有多少秒
+
+        Returns:
+            剩余秒数（已到期返回0），缓冲区为空时返回 None
+        """
+        if not self.parts:
+            return None
+        return max(0.0, self.window - (time.monotonic() - self.last_flush))
+
+    def flush(self) -> Optional[Tuple[int, Optional[str], str]]:
+        """取出缓冲区中的全部增量
+
+        Returns:
+            (event_type, block_id, text)，缓冲区为空时返回 None
+        """
+        if not self.parts:
+            return None
+        batch = (self.event_type, self.block_id, "".join(self.parts))
+        self.parts = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+        return batch
+
+
+_STREAM_END = object()  # 上游流结束的哨兵
+_FLUSH_DUE = object()  # 合并缓冲到期的哨兵（由定时器放入队列）
+
+
+class _StreamError:
+    """上游流抛出的异常（由消费方重新抛出）"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+async def _pump_stream(source: AsyncIterator[Any], queue: asyncio.Queue) -> None:
+    """在独立任务中消费上游流，把 chunk 依次放入队列
+
+    Args:
+        source: 上游异步迭代器
+        queue: 输出队列（结束时放入 _STREAM_END，出错时放入 _StreamError）
+    """
+    try:
+        async for chunk in source:
+            await queue.put(chunk)
+    except Exception as e:  # pylint: disable=broad-except
+        await queue.put(_StreamError(e))
+        return
+    finally:
+        # 被取消时上游可能停在 yield 处，显式关闭以执行其清理逻辑
+        aclose = getattr(source, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    await queue.put(_STREAM_END)
+
+
+async def _iter_with_flush_deadline(
+    source: AsyncIterator[Any],
+    coalescer: "_DeltaCoalescer"
+) -> AsyncIterator[Any]:
+    """逐个产出上游 chunk；合并缓冲中有待发增量且到期前上游没有新数据时，产出 None 提示调用方 flush
+
+    上游在独立任务中消费（整个上游生成器始终运行在同一个任务和上下文中），
+    这样等待上游（工具执行、模型停顿）时也能按时唤醒，增量最多延迟 coalescer.window 秒。
+    到期唤醒使用一个 loop.call_later 定时器：缓冲区由空变为非空时设置一次、flush 后取消，
+    等待上游时不再为每个 chunk 创建超时任务。
+
+    Args:
+        source: 上游异步迭代器
+        coalescer: 增量合并器
+
+    Yields:
+        上游 chunk，或表示“缓冲已到期”的 None
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=1)  # ✅ 只预取一个 chunk，保持对上游的背压
+    pump = asyncio.create_task(_pump_stream(source, queue))
+    deadline = None  # 缓冲到期定时器
+
+    def _on_deadline():
+        nonlocal deadline
+        deadline = None
+        # 队列已满说明有 chunk 待处理，消费方不在等待，取出后会重新检查是否到期
+        if queue.empty():
+            queue.put_nowait(_FLUSH_DUE)
+
+    try:
+        while True:
+            time_left = coalescer.time_left()
+            if time_left is None:
+                if deadline is not None:
+                    deadline.cancel()  # 缓冲已发出
+                    deadline = None
+            elif time_left <= 0:
+                yield None
+                continue
+            elif deadline is None:
+                deadline = loop.call_later(time_left, _on_deadline)
+
+            item = await queue.get()
+            if item is _FLUSH_DUE:
+                continue  # 回到循环开头重新检查（期间缓冲可能已发出或重新开始计时）
+            if item is _STREAM_END:
+                return
+            if isinstance(item, _StreamError):
+                raise item.error
+            yield item
+    finally:
+        if deadline is not None:
+            deadline.cancel()
+        pump.cancel()  # 消费方提前结束（停止生成/断开连接）时取消上游
+
 
 class ChatService:
     """聊天服务"""
@@ -73,14 +481,31 @@ class ChatService:
             event_type: 事件类型代码
 
         Returns:
-            包装后的消息
+            包装后的消息（event_data 为 UTF-8 编码的 JSON bytes，由发送端统一解码后发送）
         """
         return {
-            "event_data": json.dumps(event_data, ensure_ascii=False, default=str),
+            "event_data": orjson.dumps(event_data, default=str),
             "event_id": str(event_id),
             "event_type": event_type
         }
 
+    def _insert_returning(self, model, **values):
+        """使用 INSERT ... RETURNING 插入一行并返回ORM对象
+
+        数据库生成的字段（如自增id）随插入一并返回；返回的对象已从会话中分离，
+        提交事务时不会被过期，调用方无需再 refresh（省去一次 SELECT 往返）。
+
+        Args:
+            model: ORM模型类
+            **values: 字段值
+
+        Returns:
+            插入的ORM对象
+        """
+        obj = self.db.scalars(insert(model).values(**values).returning(model)).one()
+        self.db.expunge(obj)
+        return obj
+
     # ============ 模型管理 ============
 
     def get_models(self, only_active: bool = True) -> List[AIModel]:
@@ -97,21 +522,101 @@ class ChatService:
             query = query.filter(AIModel.is_active == True)  # noqa: E712
         return query.order_by(AIModel.display_order).all()
 
-    def get_model_by_id(self, model_id: str) -> Optional[AIModel]:
-        """根据model_id获取模型配置
+    def get_model_by_id(self, model_id: str) -> Optional[ModelConfig]:
+        """根据model_id获取模型配置（进程内缓存 _MODEL_CACHE_TTL 秒 → Redis缓存 → 数据库）
 
         Args:
             model_id: 模型ID
 
         Returns:
-            模型对象，如果不存在则返回None
+            模型配置快照，如果不存在或未激活则返回None
         """
-        return self.db.query(AIModel).filter(
+        cached = _MODEL_CACHE.get(model_id)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+
+        # ✅ 进程内缓存过期后先查Redis（多个worker进程共享），未命中再查数据库
+        cached_config = redis_service.get_model_config(model_id)
+        if cached_config is not None:
+            # 空字典是负缓存：模型不存在或未激活
+            config = ModelConfig(**cached_config) if cached_config else None
+            _MODEL_CACHE[model_id] = (
+                time.monotonic() + (_MODEL_CACHE_TTL if config else _MODEL_MISS_TTL), config
+            )
+            return config
+
+        model = self.db.query(AIModel).filter(
             and_(
                 AIModel.model_id == model_id,
                 AIModel.is_active == True  # noqa: E712
             )
         ).first()
+        if not model:
+            self._cache_model_miss(model_id)
+            return None
+
+        return self._cache_model_config(model)
+
+    def prefetch_models(self, model_ids) -> None:
+        """批量预热模型配置缓存：进程内缓存未命中的模型用一条 IN 查询取回（列表接口避免逐个会话查询）
+
+        查询不到（已删除或未激活）的模型写入负缓存，之后逐个会话的 get_model_by_id 不再查询 Redis 和数据库。
+
+        Args:
+            model_ids: 模型ID集合
+        """
+        now = time.monotonic()
+        missing = [
+            model_id for model_id in set(model_ids)
+            if not (model_id in _MODEL_CACHE and now < _MODEL_CACHE[model_id][0])
+        ]
+        if not missing:
+            return
+
+        models = self.db.query(AIModel).filter(
+            and_(
+                AIModel.model_id.in_(missing),
+                AIModel.is_active == True  # noqa: E712
+            )
+        ).all()
+        for model in models:
+            self._cache_model_config(model)
+        for model_id in set(missing).difference(model.model_id for model in models):
+            self._cache_model_miss(model_id)
+
+    @staticmethod
+    def _cache_model_config(model: AIModel) -> ModelConfig:
+        """把模型行转换为配置快照并写入进程内缓存和Redis缓存
+
+        Args:
+            model: 模型ORM对象
+
+        Returns:
+            模型配置快照
+        """
+        # ✅ 缓存与数据库会话无关的纯数据快照，不跨请求共享ORM对象
+        config = ModelConfig(
+            model_id=model.model_id,
+            provider=model.provider,
+            base_url=model.base_url,
+            max_tokens=model.max_tokens,
+            max_context_length=model.max_context_length,
+            supports_streaming=model.supports_streaming,
+            supports_tools=model.supports_tools,
+        )
+        _MODEL_CACHE[model.model_id] = (time.monotonic() + _MODEL_CACHE_TTL, config)
+        redis_service.save_model_config(model.model_id, asdict(config), expire_seconds=int(_MODEL_CACHE_TTL))
+        return config
+
+    @staticmethod
+    def _cache_model_miss(model_id: str) -> None:
+        """把不存在或未激活的模型写入负缓存（进程内缓存和Redis缓存，过期时间 _MODEL_MISS_TTL）
+
+        Args:
+            model_id: 模型ID
+        """
+        _MODEL_CACHE[model_id] = (time.monotonic() + _MODEL_MISS_TTL, None)
+        redis_service.save_model_config(model_id, {}, expire_seconds=int(_MODEL_MISS_TTL))
 
     # ============ 会话管理 ============
 
@@ -137,7 +642,9 @@ class ChatService:
         Returns:
             创建的会话对象
         """
-        session = ChatSession(
+        # ✅ INSERT ... RETURNING 一次往返拿回数据库默认值（id、created_at、计数等），提交后无需 refresh
+        session = self._insert_returning(
+            ChatSession,
             session_id=uuid4(),  # UUID类型，不需要转字符串
             user_id=user.id,
             title=title or "新对话",
@@ -148,9 +655,7 @@ class ChatService:
             max_tokens=max_tokens,
             last_activity_at=datetime.utcnow(),
         )
-        self.db.add(session)
         self.db.commit()
-        self.db.refresh(session)
         return session
 
     def get_sessions(
@@ -226,16 +731,33 @@ class ChatService:
         Returns:
             更新后的会话对象
         """
-        session = self.get_session(session_id, user)
+        values = {
+            key: value for key, value in kwargs.items()
+            if value is not None and key in _SESSION_COLUMNS
+        }
+        if not values:
+            return self.get_session(session_id, user)
+
+        # ✅ 单条 UPDATE ... RETURNING 完成权限校验、更新和回读
+        session = self.db.scalars(
+            update(ChatSession)
+            .where(
+                and_(
+                    ChatSession.session_id == session_id,
+                    ChatSession.user_id == user.id,
+                    or_(ChatSession.status != 'deleted', ChatSession.status.is_(None))
+                )
+            )
+            .values(**values)
+            .returning(ChatSession)
+        ).one_or_none()
         if not session:
+            self.db.rollback()
             return None
 
-        for key, value in kwargs.items():
-            if value is not None and hasattr(session, key):
-                setattr(session, key, value)
-
+        # 分离对象，避免提交后被过期而触发重新查询
+        self.db.expunge(session)
         self.db.commit()
-        self.db.refresh(session)
         return session
 
     def delete_session(self, session_id: str, user: User) -> bool:
@@ -285,7 +807,8 @@ class ChatService:
 
         # 创建用户消息
         user_msg_id = uuid4()  # UUID类型，不需要转字符串
-        user_message = ChatMessage(
+        user_message = self._insert_returning(
+            ChatMessage,
             message_id=user_msg_id,
             round_id=user_msg_id,  # ✅ 用户消息使用自己的message_id作为round_id（独立轮次）
             session_id=session.session_id,
@@ -299,12 +822,10 @@ class ChatService:
             sent_at=datetime.utcnow()
         )
 
-        self.db.add(user_message)
         session.last_activity_at = datetime.utcnow()
         session.message_count += 1
 
         self.db.commit()
-        self.db.refresh(user_message)
 
         return user_message
 
@@ -328,13 +849,14 @@ class ChatService:
         if not session:
             return []
 
-        # 1. 查询所有消息
+        # 1. 查询最近的消息（倒序走索引尾部读取 limit 条，再翻转回时间正序）
         all_messages = self.db.query(ChatMessage).filter(
             and_(
                 ChatMessage.session_id == session_id,
                 ChatMessage.is_deleted == False  # noqa: E712
             )
-        ).order_by(ChatMessage.created_at, ChatMessage.display_order).limit(limit).all()
+        ).order_by(desc(ChatMessage.created_at), desc(ChatMessage.display_order)).limit(limit).all()
+        all_messages.reverse()
 
         # 2. 按created_at分组（同一轮对话的消息有相同的created_at）
         from collections import defaultdict
@@ -378,7 +900,7 @@ class ChatService:
                             "type": "tool_call",
                             "tool_id": tool_call.get("id", str(msg.message_id)),
                             "tool_name": tool_call.get("function", {}).get("name", "unknown"),
-                            "tool_args": json.loads(tool_call.get("function", {}).get("arguments", "{}")) if isinstance(tool_call.get("function", {}).get("arguments"), str) else tool_call.get("function", {}).get("arguments", {}),
+                            "tool_args": orjson.loads(tool_call.get("function", {}).get("arguments", "{}")) if isinstance(tool_call.get("function", {}).get("arguments"), str) else tool_call.get("function", {}).get("arguments", {}),
                             "status": "pending",
                             "timestamp": msg.created_at.isoformat()
                         })
@@ -388,7 +910,7 @@ class ChatService:
                             if event.get("type") == "tool_call" and event.get("tool_id") == msg.tool_call_id:
                                 event["status"] = "success"
                                 try:
-                                    event["result"] = json.loads(msg.content) if isinstance(msg.content, str) else msg.content
+                                    event["result"] = orjson.loads(msg.content) if isinstance(msg.content, str) else msg.content
                                 except:
                                     event["result"] = msg.content
                                 break
@@ -402,7 +924,7 @@ class ChatService:
 
     def _build_llm_messages(
         self,
-        effective_messages: List[ChatMessage],
+        effective_messages: List[Any],
         current_user_message: Optional[str] = None,
         include_thinking: bool = False
     ) -> List[Dict[str, Any]]:
@@ -417,7 +939,7 @@ class ChatService:
         - Thinking消息 → 默认跳过（is_internal=true）
 
         Args:
-            effective_messages: 有效的消息列表
+            effective_messages: 有效的消息列表（ChatMessage 或包含 _LLM_CONTEXT_COLUMNS 各列的 Row）
             current_user_message: 当前用户消息（可选）
             include_thinking: 是否包含thinking消息，默认False
 
@@ -449,8 +971,8 @@ class ChatService:
                         # 如果是字符串，解析为字典
                         if isinstance(args, str):
                             try:
-                                tc_copy["function"]["arguments"] = json.loads(args)
-                            except json.JSONDecodeError:
+                                tc_copy["function"]["arguments"] = orjson.loads(args)
+                            except orjson.JSONDecodeError:
                                 # 如果解析失败，保持原样（可能已经是字典）
                                 pass
                     tool_calls_fixed.append(tc_copy)
@@ -504,7 +1026,8 @@ class ChatService:
         Returns:
             创建的消息对象
         """
-        message = ChatMessage(
+        message = self._insert_returning(
+            ChatMessage,
             message_id=uuid4(),  # UUID类型，不需要转字符串
             session_id=session_id,
             role=role,
@@ -513,23 +1036,58 @@ class ChatService:
             status="sent",
             **kwargs
         )
-        self.db.add(message)
-        self.db.commit()
-        self.db.refresh(message)
 
-        # 更新会话的最后活动时间和消息计数
-        session = self.db.query(ChatSession).filter(
-            ChatSession.session_id == session_id
-        ).first()
-        if session:
-            session.last_activity_at = datetime.utcnow()
-            session.message_count += 1
-            if message.total_tokens:
-                session.total_tokens += message.total_tokens
-            self.db.commit()
+        # ✅ 更新会话的最后活动时间和消息计数：直接 UPDATE，与插入消息在同一事务中提交
+        session_values = {
+            "last_activity_at": datetime.utcnow(),
+            "message_count": ChatSession.message_count + 1,
+        }
+        if message.total_tokens:
+            session_values["total_tokens"] = ChatSession.total_tokens + message.total_tokens
+        self.db.execute(
+            update(ChatSession)
+            .where(ChatSession.session_id == session_id)
+            .values(**session_values)
+            .execution_options(synchronize_session=False)  # 提交后已加载的会话对象会过期重新加载
+        )
+        self.db.commit()
 
         return message
 
+    def create_messages_bulk(self, rows: List[Dict[str, Any]]) -> None:
+        """批量插入同一轮对话拆分出的消息（executemany，不逐条构造ORM对象）
+
+        只执行插入、不提交，与调用方的其他更改在同一事务中提交。
+        这些消息（thinking/tool_call/tool_result）不计入会话的 message_count，因此不更新会话计数。
+
+        Args:
+            rows: 消息字段字典列表
+        """
+        self.db.execute(insert(ChatMessage), rows)
+
+    def _get_owned_message(
+        self,
+        message_id: str,
+        user: User
+    ) -> Optional[Tuple[ChatMessage, ChatSession]]:
+        """查询属于指定用户的消息及其所属会话（单次JOIN查询）
+
+        Args:
+            message_id: 消息ID
+            user: 用户对象
+
+        Returns:
+            (消息, 会话) 元组，消息不存在或无权限时返回None
+        """
+        return self.db.query(ChatMessage, ChatSession).join(
+            ChatSession, ChatSession.session_id == ChatMessage.session_id
+        ).filter(
+            and_(
+                ChatMessage.message_id == message_id,
+                ChatSession.user_id == user.id
+            )
+        ).first()
+
     def edit_message(
         self,
         message_id: str,
@@ -546,89 +1104,114 @@ class ChatService:
         Returns:
             是否成功
         """
-        original_message = self.db.query(ChatMessage).filter(
-            ChatMessage.message_id == message_id
-        ).first()
-
-        if not original_message:
-            return False
-
-        # 检查权限
-        session = self.db.query(ChatSession).filter(
-            and_(
-                ChatSession.session_id == original_message.session_id,
-                ChatSession.user_id == user.id
-            )
-        ).first()
-
-        if not session:
+        # ✅ 消息与所属会话一次 JOIN 查出，同时完成权限检查
+        row = self._get_owned_message(message_id, user)
+        if not row:
             return False
+        original_message, session = row
 
         session_id = original_message.session_id
 
         # ✅ 统一处理逻辑（适用所有场景）
 
-        # 1. 检查是否有摘要消息
-        summary_message = self.db.query(ChatMessage).filter(
-            and_(
-                ChatMessage.session_id == session_id,
-                ChatMessage.is_summary == True,
-                ChatMessage.is_deleted == False
-            )
-        ).first()
-
-        # 2. 如果被编辑的消息已被摘要，需要恢复上下文
+        # 1. 如果被编辑的消息已被摘要，需要恢复上下文
+        # ✅ 恢复和删除摘要都用批量 UPDATE 完成，不把相关消息逐条加载为ORM对象
         if original_message.is_summarized:
             LOGGER.info(f"📝 编辑已摘要的消息 {message_id}，恢复历史上下文")
 
             # 恢复该消息及之前所有被摘要的消息
-            messages_to_restore = self.db.query(ChatMessage).filter(
-                and_(
-                    ChatMessage.session_id == session_id,
-                    ChatMessage.is_summarized == True,
-                    ChatMessage.created_at <= original_message.created_at
+            restored = self.db.execute(
+                update(ChatMessage)
+                .where(
+                    and_(
+                        ChatMessage.session_id == session_id,
+                        ChatMessage.is_summarized == True,
+                        ChatMessage.created_at <= original_message.created_at
+                    )
                 )
-            ).all()
-
-            for msg in messages_to_restore:
-                msg.is_summarized = False
+                .values(is_summarized=False)
+                .execution_options(synchronize_session=False)
+            )
 
             # 删除摘要消息
-            if summary_message:
-                summary_message.is_deleted = True
-                LOGGER.info(f"🗑️ 删除摘要消息，恢复完整历史")
+            deleted_summaries = self.db.execute(
+                update(ChatMessage)
+                .where(
+                    and_(
+                        ChatMessage.session_id == session_id,
+                        ChatMessage.is_summary == True,
+                        ChatMessage.is_deleted == False
+                    )
+                )
+                .values(is_deleted=True)
+                .execution_options(synchronize_session=False)
+            )
+            if deleted_summaries.rowcount:
+                LOGGER.info(f"🗑️ 删除摘要消息，恢复完整历史（恢复 {restored.rowcount} 条消息）")
 
-        # 3. 软删除原消息
+        # 2. 软删除原消息
+        removed_count = 0 if original_message.is_deleted else self._counts_toward_message_count(
+            original_message.role, original_message.message_subtype
+        )
         original_message.is_deleted = True
 
-        # 4. 软删除该消息之后的所有消息（包括摘要消息之后的）
-        later_messages = self.db.query(ChatMessage).filter(
-            and_(
-                ChatMessage.session_id == session_id,
-                ChatMessage.created_at > original_message.created_at,
-                ChatMessage.is_deleted == False
+        # 3. 软删除该消息之后的所有消息（包括摘要消息之后的）
+        # ✅ 一条批量 UPDATE 完成，只返回计数需要的列，不把后续消息逐条加载为ORM对象
+        later_rows = self.db.execute(
+            update(ChatMessage)
+            .where(
+                and_(
+                    ChatMessage.session_id == session_id,
+                    ChatMessage.created_at > original_message.created_at,
+                    ChatMessage.is_deleted == False
+                )
             )
+            .values(is_deleted=True)
+            .returning(ChatMessage.role, ChatMessage.message_subtype)
+            .execution_options(synchronize_session=False)
         ).all()
 
-        for msg in later_messages:
-            msg.is_deleted = True
-            LOGGER.debug(f"🗑️ 软删除后续消息: {msg.id}")
-
-        # 5. 更新会话统计和上下文token
-        session.message_count = self.db.query(ChatMessage).filter(
-            and_(
-                ChatMessage.session_id == session_id,
-                ChatMessage.is_deleted == False
-            )
-        ).count()
-        session.current_context_tokens = self.calculate_current_context_tokens(session_id)
+        removed_count += sum(
+            self._counts_toward_message_count(role, message_subtype)
+            for role, message_subtype in later_rows
+        )
+        LOGGER.debug(f"🗑️ 软删除后续消息: {len(later_rows)} 条")
+
+        # 4. 更新会话统计和上下文token（按删除数量增量更新，避免 COUNT(*) 全量统计）
+        session.message_count = max(0, (session.message_count or 0) - removed_count)
+        # ✅ 上下文token以子查询形式嵌入会话的 UPDATE（原消息之前最新一条助手消息），不再单独 SELECT 一次
+        session.current_context_tokens = func.coalesce(
+            self._context_tokens_query(session_id, before=original_message.created_at).scalar_subquery(),
+            0
+        )
         session.last_activity_at = datetime.utcnow()
         self.db.commit()
 
+        # ✅ 历史已变化，清除LLM上下文缓存
+        redis_service.delete_session_context(str(session_id))
+
         LOGGER.info(f"✅ 消息编辑完成: 已删除原消息和后续回复，等待前端发送新消息")
 
         return True
 
+    @staticmethod
+    def _counts_toward_message_count(role: str, message_subtype: Optional[str]) -> bool:
+        """判断消息是否计入会话的 message_count
+
+        与创建时的计数规则保持一致：只统计用户消息和助手的最终回复，
+        thinking/tool_call/tool_result 子消息和摘要消息不计数。
+
+        Args:
+            role: 消息角色
+            message_subtype: 消息子类型
+
+        Returns:
+            是否计入消息数
+        """
+        if role == "user":
+            return True
+        return role == "assistant" and message_subtype in (None, "final_response")
+
     def delete_message(self, message_id: str, user: User) -> bool:
         """删除消息（软删除）
 
@@ -639,26 +1222,17 @@ class ChatService:
         Returns:
             是否成功删除
         """
-        message = self.db.query(ChatMessage).filter(
-            ChatMessage.message_id == message_id
-        ).first()
-
-        if not message:
-            return False
-
-        # 检查权限
-        session = self.db.query(ChatSession).filter(
-            and_(
-                ChatSession.session_id == message.session_id,
-                ChatSession.user_id == user.id
-            )
-        ).first()
-
-        if not session:
+        # ✅ 消息与所属会话一次 JOIN 查出，同时完成权限检查
+        row = self._get_owned_message(message_id, user)
+        if not row:
             return False
+        message, _session = row
 
         message.is_deleted = True
         self.db.commit()
+
+        # ✅ 历史已变化，清除LLM上下文缓存
+        redis_service.delete_session_context(str(message.session_id))
         return True
 
     # ============ Token 计算 ============
@@ -710,59 +1284,136 @@ class ChatService:
 
         return session_dict
 
-    def calculate_current_context_tokens(
-        self,
-        session_id: str
-    ) -> int:
-        """计算当前上下文的token总数
+    def _context_tokens_query(self, session_id: str, before: Optional[datetime] = None):
+        """构建查询：最新一条未删除助手消息的 total_tokens（即 current_context_tokens 的口径）
 
-        下一轮对话的上下文包括：
-        1. 最新消息的 prompt_tokens（之前的所有上下文）
-        2. 最新助手消息的 completion_tokens（这条回复也会成为下次的上下文）
+        下一轮对话的上下文 = 最新助手消息的 prompt_tokens（之前的所有上下文）+ completion_tokens（这条回复），
+        即该消息的 total_tokens。
 
-        即：current_context_tokens = latest_message.total_tokens
+        Args:
+            session_id: 会话ID
+            before: 只看该时间之前的消息（可选，编辑消息时传入原消息的创建时间）
+
+        Returns:
+            只查询 total_tokens 一列、最多一行的查询对象
+        """
+        conditions = [
+            ChatMessage.session_id == session_id,
+            ChatMessage.is_deleted == False,
+            ChatMessage.role == "assistant"  # 只看助手消息，因为它有完整的token统计
+        ]
+        if before is not None:
+            conditions.append(ChatMessage.created_at < before)
+
+        return self.db.query(ChatMessage.total_tokens).filter(
+            and_(*conditions)
+        ).order_by(ChatMessage.created_at.desc()).limit(1)
+
+    # ============ 摘要生成 ============
+
+    async def generate_session_summary(
+        self,
+        session_id: str,
+        user: User
+    ) -> Optional[ChatMessage]:
+        """生成会话摘要
 
         Args:
             session_id: 会话ID
+            user: 用户对象
 
         Returns:
-            当前上下文token总数
+            摘要消息对象，如果不需要摘要则返回None
         """
-        # 获取最新一条未删除的助手消息
-        latest_message = self.db.query(ChatMessage).filter(
-            and_(
-                ChatMessage.session_id == session_id,
-                ChatMessage.is_deleted == False,
-                ChatMessage.role == "assistant"  # 只看助手消息，因为它有完整的token统计
+        # ✅ 读取阶段（同步数据库查询）放到线程中执行，长会话的消息扫描不阻塞其他连接的流式回复
+        collected = await asyncio.to_thread(self._collect_summary_messages, session_id, user)
+        if collected is None:
+            return None
+        ai_model, messages_to_summarize, messages_to_keep = collected
+
+        # 构建摘要提示词
+        conversation_text = "\n\n".join([
+            f"{msg.role}: {msg.content}"
+            for msg in messages_to_summarize
+        ])
+
+        summary_prompt = f"""请对以下对话进行简洁的摘要，保留关键信息和上下文：
+
+{conversation_text}
+
+要求：
+1. 概括主要讨论的话题和结论
+2. 保留重要的事实信息
+3. 控制在200字以内
+
+摘要："""
+
+        # 调用LLM生成摘要
+        model_config = await asyncio.to_thread(self.get_model_by_id, ai_model or "qwen3:8b")
+        if not model_config:
+            raise ValueError("模型不存在")
+
+        client = FACTORY.create_client(
+            provider=model_config.provider,
+            model_id=model_config.model_id,
+            base_url=model_config.base_url
+        )
+
+        try:
+            # 非流式调用生成摘要
+            response = await client.chat(
+                messages=[{"role": "user", "content": summary_prompt}],
+                stream=False
             )
-        ).order_by(ChatMessage.created_at.desc()).first()
+            summary_content = response.get("content", "")
+            prompt_tokens = _estimate_tokens(summary_prompt)
+            completion_tokens = _estimate_tokens(summary_content)
 
-        if not latest_message or not latest_message.total_tokens:
-            return 0
+            # ✅ 摘要生效后的上下文 = 摘要 + 保留的最近几组消息（按字符估算），下一轮回复后再由实际 usage 覆盖
+            context_tokens = completion_tokens + sum(
+                _estimate_tokens(msg.content or "") for msg in messages_to_keep
+            )
 
-        # 下次对话的上下文 = 当前消息的 total_tokens
-        # (prompt_tokens + completion_tokens)
-        current_context = latest_message.total_tokens
+            # ⚠️ 写入放到线程中执行：触发摘要的那一轮对话在提交前持有会话行锁，
+            # 在事件循环上同步等待这把锁会卡住那一轮对话本身
+            summary_message = await asyncio.to_thread(
+                self._save_session_summary,
+                session_id,
+                summary_content,
+                prompt_tokens,
+                completion_tokens,
+                [msg.id for msg in messages_to_summarize],
+                context_tokens
+            )
 
-        LOGGER.debug(f"上下文Token: {current_context} (来自消息 {latest_message.message_id}: prompt={latest_message.prompt_tokens} + completion={latest_message.completion_tokens})")
+            LOGGER.info(f"✅ 会话 {session_id} 摘要已生成，覆盖 {len(messages_to_summarize)} 条消息")
 
-        return current_context
+            # 同时保存到Redis缓存（2小时）
+            await asyncio.to_thread(
+                redis_service.save_session_summary, str(session_id), summary_content, expire_seconds=7200
+            )
+            await asyncio.to_thread(redis_service.delete_session_context, str(session_id))
 
-    # ============ 摘要生成 ============
+            return summary_message
 
-    async def generate_session_summary(
+        except Exception as e:
+            LOGGER.error(f"生成摘要失败: {e}")
+            return None
+        # 注意：不要关闭客户端，因为是从 FACTORY 缓存获取的共享实例
+
+    def _collect_summary_messages(
         self,
         session_id: str,
         user: User
-    ) -> Optional[ChatMessage]:
-        """生成会话摘要
+    ) -> Optional[Tuple[Optional[str], List[Any], List[Any]]]:
+        """读取会话中未摘要的消息，按轮次分组后划分为需要摘要的部分和保留的最近5组
 
         Args:
             session_id: 会话ID
             user: 用户对象
 
         Returns:
-            摘要消息对象，如果不需要摘要则返回None
+            (会话使用的模型ID, 需要摘要的消息, 保留的消息)，消息组数不足无需摘要时返回None
         """
         session = self.get_session(session_id, user)
         if not session:
@@ -770,14 +1421,21 @@ class ChatService:
 
         # 获取所有未删除且未被摘要的消息
         # 🎯 关键改进：按round_id分组，确保同一轮对话不被切割
-        all_messages = self.db.query(ChatMessage).filter(
+        # ✅ 只查询分组、拼接摘要和标记需要的列（轻量 Row，不构造ORM对象），按批流式读取
+        all_messages = self.db.query(
+            ChatMessage.id,
+            ChatMessage.round_id,
+            ChatMessage.created_at,
+            ChatMessage.role,
+            ChatMessage.content
+        ).filter(
             and_(
                 ChatMessage.session_id == session_id,
                 ChatMessage.is_deleted == False,
                 ChatMessage.is_summarized == False,
                 ChatMessage.is_summary == False
             )
-        ).order_by(ChatMessage.created_at, ChatMessage.round_id, ChatMessage.display_order).all()
+        ).order_by(ChatMessage.created_at, ChatMessage.round_id, ChatMessage.display_order).yield_per(500)
 
         # 按round_id分组（同一轮对话的消息共享一个round_id）
         from collections import OrderedDict
@@ -805,80 +1463,167 @@ class ChatService:
 
         LOGGER.info(f"摘要生成: 共{len(message_groups)}组消息, 摘要{len(groups_to_summarize)}组({len(messages_to_summarize)}条), 保留{len(groups_to_keep)}组({len(messages_to_keep)}条)")
 
-        # 构建摘要提示词
-        conversation_text = "\n\n".join([
-            f"{msg.role}: {msg.content}"
-            for msg in messages_to_summarize
-        ])
-
-        summary_prompt = f"""请对以下对话进行简洁的摘要，保留关键信息和上下文：
+        return session.ai_model, messages_to_summarize, messages_to_keep
 
-{conversation_text}
+    def _save_session_summary(
+        self,
+        session_id: str,
+        summary_content: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        summarized_ids: List[int],
+        context_tokens: int
+    ) -> ChatMessage:
+        """写入摘要消息、标记被摘要的消息并重置会话的上下文token（同一事务提交）
 
-要求：
-1. 概括主要讨论的话题和结论
-2. 保留重要的事实信息
-3. 控制在200字以内
+        Args:
+            session_id: 会话ID
+            summary_content: 摘要内容
+            prompt_tokens: 摘要提示词的估算token数
+            completion_tokens: 摘要内容的估算token数
+            summarized_ids: 被摘要的消息主键ID列表
+            context_tokens: 摘要生效后的上下文估算token数
 
-摘要："""
+        Returns:
+            摘要消息对象
+        """
+        # 创建摘要消息
+        summary_message = self._insert_returning(
+            ChatMessage,
+            message_id=uuid4(),  # UUID类型，不需要转字符串
+            session_id=session_id,
+            role="system",
+            content=f"【对话摘要】{summary_content}",
+            message_type="summary",
+            is_summary=True,
+            sent_at=datetime.utcnow(),
+            status="sent",
+            # Token统计（非流式接口不返回 usage，按字符估算）
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
 
-        # 调用LLM生成摘要
-        model_config = self.get_model_by_id(session.ai_model or "qwen3:8b")
-        if not model_config:
-            raise ValueError("模型不存在")
+        # 标记旧消息为已摘要（一条批量 UPDATE，不逐条 flush）
+        self.db.execute(
+            update(ChatMessage)
+            .where(ChatMessage.id.in_(summarized_ids))
+            .values(is_summarized=True)
+            .execution_options(synchronize_session=False)
+        )
 
-        client = FACTORY.create_client(
-            provider=model_config.provider,
-            model_id=model_config.model_id,
-            base_url=model_config.base_url
+        # ✅ 重置会话的上下文token：否则仍停留在阈值以上，后续每一轮都会再次触发摘要
+        self.db.execute(
+            update(ChatSession)
+            .where(ChatSession.session_id == session_id)
+            .values(current_context_tokens=context_tokens)
+            .execution_options(synchronize_session=False)
         )
 
-        try:
-            # 非流式调用生成摘要
-            response = await client.chat(
-                messages=[{"role": "user", "content": summary_prompt}],
-                stream=False
-            )
-            summary_content = response.get("content", "")
+        self.db.commit()
+        return summary_message
 
-            # 创建摘要消息
-            summary_message = ChatMessage(
-                message_id=uuid4(),  # UUID类型，不需要转字符串
-                session_id=session_id,
-                role="system",
-                content=f"【对话摘要】{summary_content}",
-                message_type="summary",
-                is_summary=True,
-                sent_at=datetime.utcnow(),
-                status="sent",
-                # Token统计（假设response中有，否则需要估算）
-                prompt_tokens=len(summary_prompt.split()) * 2,  # 粗略估算
-                completion_tokens=len(summary_content.split()) * 2,
-                total_tokens=len(summary_prompt.split()) * 2 + len(summary_content.split()) * 2
-            )
+    def _schedule_summary_if_needed(self, session: ChatSession, model_max_context: int) -> bool:
+        """上下文达到阈值时在后台触发摘要生成（不阻塞本轮回复）
 
-            self.db.add(summary_message)
+        Args:
+            session: 会话对象
+            model_max_context: 模型上下文窗口大小
 
-            # 标记旧消息为已摘要
-            for msg in messages_to_summarize:
-                msg.is_summarized = True
+        Returns:
+            本轮是否处于摘要待生效状态（达到阈值）
+        """
+        if (session.current_context_tokens or 0) < int(model_max_context * 0.9):
+            return False
 
-            self.db.commit()
-            self.db.refresh(summary_message)
+        LOGGER.info(f"🔄 会话 {session.session_id} 上下文达到阈值 ({session.current_context_tokens}/{model_max_context}), 后台触发摘要生成")
+        _schedule_session_summary(str(session.session_id), session.user_id)
+        return True
 
-            LOGGER.info(f"✅ 会话 {session_id} 摘要已生成，覆盖 {len(messages_to_summarize)} 条消息")
+    # ============ AI对话 ============
 
-            # 同时保存到Redis缓存（2小时）
-            redis_service.save_session_summary(str(session_id), summary_content, expire_seconds=7200)
+    @staticmethod
+    def _get_system_prompt(user_id: str, session: ChatSession) -> str:
+        """获取用户的系统提示词（进程内缓存 _SYSTEM_PROMPT_CACHE_TTL 秒 → Redis缓存 → 会话设置/默认值）
 
-            return summary_message
+        Args:
+            user_id: 用户ID
+            session: 会话对象
 
-        except Exception as e:
-            LOGGER.error(f"生成摘要失败: {e}")
-            return None
-        # 注意：不要关闭客户端，因为是从 FACTORY 缓存获取的共享实例
+        Returns:
+            系统提示词
+        """
+        cached = _SYSTEM_PROMPT_CACHE.get(user_id)
+        if cached and time.monotonic() - cached[0] < _SYSTEM_PROMPT_CACHE_TTL:
+            return cached[1]
 
-    # ============ AI对话 ============
+        system_prompt = redis_service.get_user_preference(user_id, "system_prompt")
+        if not system_prompt:
+            system_prompt = session.system_prompt or DEFAULT_SYSTEM_PROMPT
+            # 保存到缓存（24小时）
+            redis_service.save_user_preference(user_id, "system_prompt", system_prompt, expire_seconds=86400)
+
+        _SYSTEM_PROMPT_CACHE[user_id] = (time.monotonic(), system_prompt)
+        return system_prompt
+
+    def _load_llm_context(
+        self,
+        session_id: str,
+        content: str,
+        skip_user_message: bool
+    ) -> List[Dict[str, Any]]:
+        """从数据库重建LLM上下文（有效历史消息 + 摘要）
+
+        Args:
+            session_id: 会话ID
+            content: 本轮用户消息内容
+            skip_user_message: 用户消息是否已提前写入（此时历史中已包含本轮用户消息）
+
+        Returns:
+            OpenAI格式的消息列表
+        """
+        # ✅ 步骤2：获取有效消息（未删除且未被摘要的）
+        # ⚠️ 助手占位符此时尚未加入数据库会话，不会出现在结果中
+        # ✅ 只查询构建上下文需要的列（返回轻量 Row，不构造ORM对象）
+        effective_messages = self.db.query(*_LLM_CONTEXT_COLUMNS).filter(
+            and_(
+                ChatMessage.session_id == session_id,
+                ChatMessage.is_deleted == False,
+                ChatMessage.is_summarized == False  # 不包含已被摘要的
+            )
+        ).order_by(ChatMessage.created_at).all()
+
+        # ✅ 步骤3：获取摘要消息（如果有）
+        # 最新的摘要消息未被摘要覆盖，已包含在上面的查询结果中（_build_llm_messages 会跳过 system 消息），
+        # 直接取最后一条，无需再单独查询一次
+        summary_content = None
+        for row in effective_messages:
+            if row.is_summary:
+                summary_content = row.content
+
+        # ✅ 步骤4：构建LLM上下文消息（从消息流中提取，符合OpenAI标准）
+        messages = self._build_llm_messages(
+            effective_messages=effective_messages[:-1] if not skip_user_message else effective_messages,
+            current_user_message=content if not skip_user_message else None
+        )
+
+        # ✅ 步骤5：添加摘要到消息列表开头（如果有）
+        if summary_content:
+            messages.insert(0, {"role": "system", "content": summary_content})
+            LOGGER.info(f"✅ 包含摘要消息: {summary_content[:50]}...")
+
+        return messages
+
+    def _release_db_session(self, session: ChatSession) -> None:
+        """读取阶段结束后关闭数据库会话、归还连接（流式生成期间不占用连接）
+
+        Args:
+            session: 会话对象（关闭后变为 detached，属性仍可读取）
+        """
+        # 先刷新被之前的 commit 过期的会话对象，否则 detached 后无法再加载属性
+        if inspect(session).expired_attributes:
+            self.db.refresh(session)
+        self.db.close()
 
     async def send_message_streaming(
         self,
@@ -902,28 +1647,30 @@ class ChatService:
             kb_id: 知识库ID（可选，用于RAG检索）
 
         Yields:
-            WebSocket消息字典
+            WebSocket消息字典（增量帧复用同一个字典，调用方需在取下一帧前处理完毕，不要保留引用）
         """
         # ✅ 事件计数器：事件类型变化时归零
         event_id = 0
         current_event_type = None  # 跟踪当前事件类型
         message_index = 0
-        error_message_id = str(uuid4())
+        session_id_str = str(session_id)  # ✅ 整个流中复用，避免每个事件重复转换UUID
 
         # 获取会话
-        session = self.get_session(session_id, user)
+        # ✅ 同步数据库调用放到线程中执行，避免阻塞事件循环（其他连接的流式推送不受DB延迟影响）
+        session = await asyncio.to_thread(self.get_session, session_id, user)
         if not session:
+            error_message_id = str(uuid4())  # ✅ 只在出错时生成，错误帧内外共用同一个ID
             event_id, current_event_type = self._get_next_event_id(
                 EventType.ERROR, current_event_type, event_id
             )
             yield self._wrap_ws_message(
                 event_data={
                     "message_id": error_message_id,
-                    "conversation_id": str(session_id),
+                    "conversation_id": session_id_str,
                     "message": {
-                        "id": str(uuid4()),
+                        "id": error_message_id,
                         "content_type": ContentType.ERROR,
-                        "content": json.dumps({"error": "会话不存在"})
+                        "content": _json_str({"error": "会话不存在"})
                     },
                     "status": MessageStatus.ERROR,
                     "is_finish": True,
@@ -936,16 +1683,17 @@ class ChatService:
 
         # 确定使用的模型
         target_model_id = model_id or session.ai_model or "qwen3:8b"
-        model_config = self.get_model_by_id(target_model_id)
+        model_config = await asyncio.to_thread(self.get_model_by_id, target_model_id)
         if not model_config:
+            error_message_id = str(uuid4())
             yield self._wrap_ws_message(
                 event_data={
                     "message_id": error_message_id,
-                    "conversation_id": str(session_id),
+                    "conversation_id": session_id_str,
                     "message": {
-                        "id": str(uuid4()),
+                        "id": error_message_id,
                         "content_type": ContentType.ERROR,
-                        "content": json.dumps({"error": f"模型 {target_model_id} 不存在或未激活"})
+                        "content": _json_str({"error": f"模型 {target_model_id} 不存在或未激活"})
                     },
                     "status": MessageStatus.ERROR,
                     "is_finish": True,
@@ -959,7 +1707,8 @@ class ChatService:
         # 创建用户消息（保存到数据库）
         # ✅ 编辑重新生成时跳过创建新的用户消息
         if not skip_user_message:
-            _user_message = self.create_message(
+            _user_message = await asyncio.to_thread(
+                self.create_message,
                 session_id=session_id,
                 role="user",
                 content=content,
@@ -977,12 +1726,9 @@ class ChatService:
             model_name=target_model_id,
             sent_at=datetime.utcnow()
         )
-        self.db.add(assistant_message_placeholder)
-        self.db.flush()  # 立即写入以获取ID，但不提交
+        # ⚠️ 此时不加入数据库会话：等读取阶段结束、归还连接后再加入（见下方"创建AI客户端"之前）
         assistant_message_id = assistant_message_placeholder.message_id
-
-        # ✅ 增加消息计数（创建助手消息）
-        session.message_count += 1
+        assistant_message_id_str = str(assistant_message_id)
 
         # 发送开始消息
         event_id, current_event_type = self._get_next_event_id(
@@ -990,8 +1736,8 @@ class ChatService:
         )
         yield self._wrap_ws_message(
             event_data={
-                "message_id": str(assistant_message_id),
-                "conversation_id": str(session_id),
+                "message_id": assistant_message_id_str,
+                "conversation_id": session_id_str,
                 "status": MessageStatus.PENDING,
                 "message_index": message_index
             },
@@ -1001,44 +1747,41 @@ class ChatService:
         message_index += 1
 
         # ✅ 步骤1：检查是否需要生成摘要（在获取历史前）
+        # 摘要在后台任务中生成，不阻塞本轮回复；本轮仍使用未摘要的上下文，摘要从下一轮开始生效
         model_max_context = model_config.max_context_length or 32768
-        should_generate_summary = False
+        summary_pending = self._schedule_summary_if_needed(session, model_max_context)
 
-        if session.current_context_tokens >= int(model_max_context * 0.9):
-            LOGGER.info(f"🔄 会话 {session_id} 上下文达到阈值 ({session.current_context_tokens}/{model_max_context}), 触发摘要生成")
-            summary_message = await self.generate_session_summary(session_id, user)
-            should_generate_summary = True
+        # ✅ 优先使用上一轮缓存的LLM上下文（普通对话轮次无需重新查询和构建历史）
+        # 同时登记本轮轮次：与同一会话的其他轮次重叠时不使用、也不写回缓存（见 RedisService.begin_session_turn）
+        cached_context, context_turn, context_exclusive = await asyncio.to_thread(
+            redis_service.begin_session_turn, session_id_str
+        )
+        context_turn_ended = False
 
-        # ✅ 步骤2：获取有效消息（未删除且未被摘要的）
-        # ⚠️ 排除刚创建的 pending 状态的助手占位符消息
-        effective_messages = self.db.query(ChatMessage).filter(
-            and_(
-                ChatMessage.session_id == session_id,
-                ChatMessage.is_deleted == False,
-                ChatMessage.is_summarized == False,  # 不包含已被摘要的
-                ChatMessage.message_id != assistant_message_id  # ⚠️ 排除占位符
-            )
-        ).order_by(ChatMessage.created_at).all()
+        try:
+            if cached_context is not None:
+                messages = cached_context
+                messages.append({"role": "user", "content": content})
+            else:
+                messages = await asyncio.to_thread(
+                    self._load_llm_context, session_id, content, skip_user_message
+                )
+        except BaseException:
+            _run_in_background(redis_service.end_session_turn, session_id_str, context_turn)
+            raise
 
-        # ✅ 步骤3：获取摘要消息（如果有）
-        summary_message = self.db.query(ChatMessage).filter(
-            and_(
-                ChatMessage.session_id == session_id,
-                ChatMessage.is_summary == True,
-                ChatMessage.is_deleted == False
-            )
-        ).order_by(ChatMessage.created_at.desc()).first()
+        # ✅ 读取阶段结束，关闭数据库会话归还连接，流式生成期间不再占用连接
+        # 关闭后已加载的对象变为 detached，属性仍可直接读取；先刷新被之前的 commit 过期的会话对象
+        await asyncio.to_thread(self._release_db_session, session)
 
-        # ✅ 步骤4：构建LLM上下文消息（从消息流中提取，符合OpenAI标准）
-        messages = self._build_llm_messages(
-            effective_messages=effective_messages[:-1] if not skip_user_message else effective_messages,
-            current_user_message=content if not skip_user_message else None
-        )
+        # ✅ 重新挂回会话：占位消息、会话统计以及流式期间产生的 LLM/工具调用记录都只加入会话、不 flush，
+        # 在最终 commit 时一起写入，届时才会再次取连接和会话行锁（工作单元按外键顺序先插入占位消息，满足调用记录的外键约束）
+        # ⚠️ 工具自身查询数据库（如知识库检索）时仍会取连接并保持到最终 commit，但不会写入、不持有会话行锁
+        self.db.add(session)
+        self.db.add(assistant_message_placeholder)
 
-        # ✅ 步骤5：添加摘要到消息列表开头（如果有）
-        if summary_message:
-            messages.insert(0, {"role": "system", "content": summary_message.content})
-            LOGGER.info(f"✅ 包含摘要消息: {summary_message.content[:50]}...")
+        # ✅ 增加消息计数（创建助手消息）
+        session.message_count += 1
 
         # 创建AI客户端
         client = FACTORY.create_client(
@@ -1062,18 +1805,65 @@ class ChatService:
             object.__setattr__(agent.adk_llm, 'llm_sequence_counter', 0)
 
         # 流式生成
-        assistant_content = ""
-        has_sent_thinking = False  # ✅ 是否已发送 thinking
-        thinking_buffer = ""  # ✅ 累积的 thinking 内容
-        last_sent_content_len = 0  # ✅ 记录已发送的 content 长度（用于多轮思考）
+        content_parts = []  # ✅ 已确认的正文片段（不含 thinking），结束时一次性 join
+        think_splitter = _ThinkTagSplitter()  # ✅ 按 <think> / </think> 拆分正文和 thinking
+        current_thinking = ""  # ✅ 流结束时仍未闭合的 thinking 块内容
+        thinking_parts = []  # ✅ 当前 thinking 块已确认的片段
         current_thinking_id = None  # ✅ 当前正在进行的 thinking 块的 ID
         timeline = []  # ✅ 记录事件时间线（thinking、tool_call、content）
-        start_time = datetime.utcnow()
+        start_monotonic = time.monotonic()  # ✅ 计算耗时使用单调时钟
+        coalescer = _DeltaCoalescer()  # ✅ 合并连续的增量帧
+        get_next_event_id = self._get_next_event_id
+        wrap_ws_message = self._wrap_ws_message
+        delta_seq = 0  # ✅ 正文段序号（段ID只需在本条消息内唯一）
+        current_content_id = None  # ✅ 当前连续正文段的 ID（同一段内的增量共享）
+        event_base = {"message_id": assistant_message_id_str, "conversation_id": session_id_str}  # ✅ 非增量事件共享的公共字段
+        delta_prefix = _delta_event_prefix(assistant_message_id_str, session_id_str)  # ✅ 本次回复的增量事件模板前缀
+        delta_envelope = {"event_data": b"", "event_id": "", "event_type": _EV_CONTENT}  # ✅ 增量帧复用的消息字典
+
+        def _delta_message(batch: Tuple[int, Optional[str], str]) -> Dict[str, Any]:
+            """把合并后的增量批次包装为 WebSocket 消息（同时推进事件ID和消息序号）"""
+            nonlocal event_id, current_event_type, message_index, delta_seq, current_content_id
+            delta_type, block_id, text = batch
+            is_thinking = delta_type == _EV_THINKING_DELTA
+            if not is_thinking:
+                if delta_type != current_event_type or current_content_id is None:
+                    # ✅ 上一个事件不是正文增量（thinking/工具等），开始新的正文段
+                    current_content_id = f"{assistant_message_id_str}-{delta_seq}"
+                    delta_seq += 1
+                block_id = current_content_id
+            if delta_type == current_event_type:
+                event_id += 1  # ✅ 同类型连续增量：直接递增，无需走通用的类型切换逻辑
+            else:
+                event_id, current_event_type = get_next_event_id(
+                    delta_type, current_event_type, event_id
+                )
+            # ✅ 复用同一个外层消息字典：调用方在取下一帧前已把当前帧发送出去，不会持有它
+            delta_envelope["event_data"] = _delta_event_data(delta_prefix, block_id, is_thinking, text, message_index)
+            delta_envelope["event_id"] = str(event_id)
+            delta_envelope["event_type"] = delta_type
+            message_index += 1
+            return delta_envelope
+
+        def _event_message(event_type: int, fields: Dict[str, Any]) -> Dict[str, Any]:
+            """包装非增量事件：补充公共字段和消息序号（同时推进事件ID和消息序号）"""
+            nonlocal event_id, current_event_type, message_index
+            event_id, current_event_type = get_next_event_id(
+                event_type, current_event_type, event_id
+            )
+            message = wrap_ws_message(
+                event_data={**event_base, **fields, "message_index": message_index},
+                event_id=event_id,
+                event_type=event_type
+            )
+            message_index += 1
+            return message
 
         # ✅ 工具调用追踪
         tool_sequence_counter = 0  # 工具调用序号
         tool_invocation_records = {}  # {tool_call_id: ToolInvocation对象}
-        tool_start_times = {}  # {tool_call_id: start_time}
+        pending_tool_calls = defaultdict(deque)  # {tool_name: deque[timeline中待返回结果的tool_call事件]}
+        tool_start_times = {}  # {tool_call_id: time.monotonic() 开始时刻}
 
         # ✅ Token 统计信息
         prompt_tokens = 0
@@ -1081,13 +1871,7 @@ class ChatService:
         total_tokens = 0
 
         # ✅ 从缓存获取用户系统提示词（优先级：缓存 > 会话设置 > 默认值）
-        cached_system_prompt = redis_service.get_user_preference(str(user.id), "system_prompt")
-        if cached_system_prompt:
-            system_prompt = cached_system_prompt
-        else:
-            system_prompt = session.system_prompt or DEFAULT_SYSTEM_PROMPT
-            # 保存到缓存（24小时）
-            redis_service.save_user_preference(str(user.id), "system_prompt", system_prompt, expire_seconds=86400)
+        system_prompt = self._get_system_prompt(str(user.id), session)
 
         # ✅ kb_id参数已废弃，完全依赖LLM主动调用 search_knowledge_base 工具
         # 如果用户传了kb_id，记录日志提示（兼容过渡期）
@@ -1099,29 +1883,55 @@ class ChatService:
 
         set_current_db_session(self.db)
         set_current_user_id(user.id)
-        set_current_session_id(str(session_id))
+        set_current_session_id(session_id_str)
 
         try:
-            async for chunk in agent.run_streaming(
+            # ✅ 上游停顿（工具执行、模型慢）时按合并窗口到期唤醒，及时发出缓冲中的增量
+            async for chunk in _iter_with_flush_deadline(agent.run_streaming(
                 messages=messages,
                 system_prompt=system_prompt,
                 tools=None,  # ✅ 工具通过 ADK 自动加载（adk_agent_adapter.py）
                 user_id=str(user.id),  # ✅ 传递真实的用户ID
-                session_id=str(session_id)  # ✅ 传递真实的会话ID
-            ):
-                if chunk["type"] == "content":
-                    content_delta = chunk["content"]
-                    assistant_content += content_delta
+                session_id=session_id_str  # ✅ 传递真实的会话ID
+            ), coalescer):
+                if chunk is None:
+                    pending = coalescer.flush()
+                    if pending:
+                        yield _delta_message(pending)
+                    continue
 
+                if chunk["type"] == "content":
                     # ✅ 检测和分离 thinking 内容（支持多轮思考，带开始/完成消息）
-                    # 提取所有完整的 <think>...</think> 块
-                    while "<think>" in assistant_content and "</think>" in assistant_content:
-                        # 找到第一个完整的 thinking 块
-                        match = re.search(r'<think>(.*?)</think>', assistant_content, re.DOTALL)
-                        if match:
-                            thinking_text = match.group(1).strip()
-                            # ✅ 使用流式时的 ID，如果没有则生成新的
-                            thinking_id = current_thinking_id if current_thinking_id else str(uuid4())
+                    for kind, text in think_splitter.feed(chunk["content"]):
+                        if kind == _SEG_CONTENT:
+                            # 发送正文 content delta（经合并后发出）
+                            content_parts.append(text)
+                            for batch in coalescer.push(_EV_CONTENT, None, text):
+                                yield _delta_message(batch)
+                        elif kind == _SEG_THINKING:
+                            # 流式发送 thinking delta
+                            thinking_parts.append(text)
+                            for batch in coalescer.push(_EV_THINKING_DELTA, current_thinking_id, text):
+                                yield _delta_message(batch)
+                        elif kind == _SEG_THINK_OPEN:
+                            # ✅ 进入新的 thinking 块：先发出缓冲中的正文增量，再发送开始消息
+                            pending = coalescer.flush()
+                            if pending:
+                                yield _delta_message(pending)
+                            current_thinking_id = str(uuid4())
+                            yield _event_message(EventType.THINKING_START, {
+                                "message": {
+                                    "id": current_thinking_id,
+                                    "content_type": ContentType.THINKING,
+                                    "content": _THINKING_START_CONTENT
+                                },
+                                "status": MessageStatus.PENDING,
+                                "is_delta": True
+                            })
+                        else:
+                            # ✅ thinking 块完成
+                            thinking_text = "".join(thinking_parts).strip()
+                            thinking_id = current_thinking_id
 
                             # 保存到时间线（只有非空内容才保存）
                             if thinking_text:
@@ -1132,152 +1942,41 @@ class ChatService:
                                     "timestamp": datetime.utcnow().isoformat()
                                 })
 
+                            # ✅ 先发出缓冲中的增量，保证事件顺序
+                            pending = coalescer.flush()
+                            if pending:
+                                yield _delta_message(pending)
                             # ✅ 发送思考完成消息（即使内容为空也要发送，确保前端状态正确）
-                            event_id, current_event_type = self._get_next_event_id(
-                                EventType.THINKING_COMPLETE, current_event_type, event_id
-                            )
-                            yield self._wrap_ws_message(
-                                event_data={
-                                    "message_id": str(assistant_message_id),
-                                    "conversation_id": str(session_id),
-                                    "message": {
-                                        "id": thinking_id,
-                                        "content_type": ContentType.THINKING,
-                                        "content": json.dumps({"finish_title": "已完成思考"})
-                                    },
-                                    "status": MessageStatus.COMPLETED,
-                                    "is_finish": True,
-                                    "message_index": message_index
-                                },
-                                event_id=event_id,
-                                event_type=EventType.THINKING_COMPLETE
-                            )
-                            message_index += 1
-
-                            # 移除这个 thinking 块
-                            assistant_content = assistant_content[:match.start()] + assistant_content[match.end():]
-                            thinking_buffer = ""  # 清空 thinking buffer
-                            current_thinking_id = None  # 清空当前 thinking ID
-                        else:
-                            break
-
-                    # 处理未完成的 thinking（只有 <think> 没有 </think>）
-                    if "<think>" in assistant_content and "</think>" not in assistant_content:
-                        think_pos = assistant_content.find("<think>")
-                        before_think = assistant_content[:think_pos]
-                        current_thinking = assistant_content[think_pos + 7:]  # 跳过 "<think>"
-
-                        # 先发送 thinking 之前的 content
-                        if before_think and last_sent_content_len < len(before_think):
-                            content_to_send = before_think[last_sent_content_len:]
-                            last_sent_content_len = len(before_think)
-                            if content_to_send:
-                                content_id = str(uuid4())
-                                event_id, current_event_type = self._get_next_event_id(
-                                    EventType.MESSAGE_CONTENT, current_event_type, event_id
-                                )
-                                yield self._wrap_ws_message(
-                                    event_data={
-                                        "message_id": str(assistant_message_id),
-                                        "conversation_id": str(session_id),
-                                        "message": {
-                                            "id": content_id,
-                                            "content_type": ContentType.TEXT,
-                                            "content": json.dumps({"text": content_to_send})  # ✅ 统一使用 text 字段
-                                        },
-                                        "status": MessageStatus.PENDING,
-                                        "is_delta": True,
-                                        "message_index": message_index
-                                    },
-                                    event_id=event_id,
-                                    event_type=EventType.MESSAGE_CONTENT
-                                )
-                                message_index += 1
-
-                        # ✅ 如果是新的 thinking 块，发送开始消息
-                        if not current_thinking_id:
-                            current_thinking_id = str(uuid4())
-                            event_id, current_event_type = self._get_next_event_id(
-                                EventType.THINKING_START, current_event_type, event_id
-                            )
-                            yield self._wrap_ws_message(
-                                event_data={
-                        "message_id": str(assistant_message_id),
-                        "conversation_id": str(session_id),
-                                    "message": {
-                                        "id": current_thinking_id,
-                                        "content_type": ContentType.THINKING,
-                                        "content": json.dumps({"finish_title": "深度思考中"})  # ✅ 对齐业界标准
-                                    },
-                                    "status": MessageStatus.PENDING,
-                                    "is_delta": True,
-                                    "message_index": message_index
-                                },
-                                event_id=event_id,
-                                event_type=EventType.THINKING_START
-                            )
-                            message_index += 1
-
-                        # 流式发送 thinking delta
-                        new_thinking_delta = current_thinking[len(thinking_buffer):]
-                        thinking_buffer = current_thinking
-
-                        if new_thinking_delta:
-                            event_id, current_event_type = self._get_next_event_id(
-                                EventType.THINKING_DELTA, current_event_type, event_id
-                            )
-                            yield self._wrap_ws_message(
-                                event_data={
-                        "message_id": str(assistant_message_id),
-                        "conversation_id": str(session_id),
-                                    "message": {
-                                        "id": current_thinking_id,
-                                        "content_type": ContentType.THINKING,
-                                        "content": json.dumps({"text": new_thinking_delta})  # ✅ 统一使用 text 字段
-                                    },
-                                    "status": MessageStatus.PENDING,
-                                    "is_delta": True,
-                                    "message_index": message_index
+                            yield _event_message(EventType.THINKING_COMPLETE, {
+                                "message": {
+                                    "id": thinking_id,
+                                    "content_type": ContentType.THINKING,
+                                    "content": _THINKING_COMPLETE_CONTENT
                                 },
-                                event_id=event_id,
-                                event_type=EventType.THINKING_DELTA
-                            )
-                            message_index += 1
-                    else:
-                        # 没有未完成的 thinking，发送普通 content delta
-                        if assistant_content and last_sent_content_len < len(assistant_content):
-                            content_to_send = assistant_content[last_sent_content_len:]
-                            last_sent_content_len = len(assistant_content)
-                            if content_to_send:
-                                content_id = str(uuid4())
-                                event_id, current_event_type = self._get_next_event_id(
-                                    EventType.MESSAGE_CONTENT, current_event_type, event_id
-                                )
-                                yield self._wrap_ws_message(
-                                    event_data={
-                                        "message_id": str(assistant_message_id),
-                                        "conversation_id": str(session_id),
-                                        "message": {
-                                            "id": content_id,
-                                            "content_type": ContentType.TEXT,
-                                            "content": json.dumps({"text": content_to_send})  # ✅ 统一使用 text 字段
-                                        },
-                                        "status": MessageStatus.PENDING,
-                                        "is_delta": True,
-                                        "message_index": message_index
-                                    },
-                                    event_id=event_id,
-                                    event_type=EventType.MESSAGE_CONTENT
-                                )
-                                message_index += 1
+                                "status": MessageStatus.COMPLETED,
+                                "is_finish": True
+                            })
 
+                            # 清空当前 thinking 状态，继续处理其后的文本
+                            thinking_parts = []
+                            current_thinking_id = None
                 elif chunk["type"] == "tool_calls":
+                    # ✅ 同一批工具调用共用一个时间戳
+                    now = datetime.utcnow()
+                    now_iso = now.isoformat()
                     for tool_call in chunk.get("tool_calls", []):
                         tool_call_id = str(uuid4())
                         tool_name = tool_call["function"]["name"]
                         tool_args = tool_call["function"]["arguments"]
+                        if isinstance(tool_args, str):
+                            # ✅ 部分模型以 JSON 字符串返回参数：解析一次后统一按对象处理，
+                            # 避免推送和存储时被当作字符串二次转义
+                            try:
+                                tool_args = orjson.loads(tool_args)
+                            except orjson.JSONDecodeError:
+                                pass
                         tool_sequence_counter += 1
-                        tool_start_times[tool_call_id] = datetime.utcnow()
+                        tool_start_times[tool_call_id] = time.monotonic()
 
                         # ✅ 创建工具调用记录（pending状态）
                         try:
@@ -1298,144 +1997,130 @@ class ChatService:
                                 cache_hit=False,
                                 error_message=None,
                                 duration_ms=None,
-                                created_at=datetime.utcnow()
+                                created_at=now
                             )
+                            # ✅ 只加入数据库会话、不单独 flush：记录按 tool_call_id 索引，无需数据库ID，
+                            # 随最终 commit 一起写入
                             self.db.add(tool_invocation)
-                            self.db.flush()  # 获取ID但不提交
                             tool_invocation_records[tool_call_id] = tool_invocation
 
                             LOGGER.info(f"✅ 创建工具调用记录 #{tool_sequence_counter}: {tool_name}")
                         except Exception as e:
                             LOGGER.error(f"创建工具调用记录失败: {e}", exc_info=True)
 
-                        # ✅ 添加到时间线
-                        timeline.append({
+                        # ✅ 添加到时间线，并登记为待返回结果的调用
+                        tool_call_event = {
                             "type": "tool_call",
                             "tool_name": tool_name,
                             "tool_args": tool_args,
                             "tool_id": tool_call_id,
                             "status": "pending",
-                            "timestamp": datetime.utcnow().isoformat()
-                        })
-                        event_id, current_event_type = self._get_next_event_id(
-                            EventType.TOOL_CALL, current_event_type, event_id
-                        )
-                        yield self._wrap_ws_message(
-                            event_data={
-                        "message_id": str(assistant_message_id),
-                        "conversation_id": str(session_id),
-                                "message": {
-                                    "id": tool_call_id,
-                                    "content_type": ContentType.TOOL_CALL,
-                                    "content": json.dumps({
-                                        "name": tool_name,
-                                        "args": tool_args
-                                    })
-                                },
-                                "status": MessageStatus.PENDING,
-                                "message_index": message_index
+                            "timestamp": now_iso
+                        }
+                        timeline.append(tool_call_event)
+                        pending_tool_calls[tool_name].append(tool_call_event)
+                        # ✅ 先发出缓冲中的增量，保证事件顺序
+                        pending = coalescer.flush()
+                        if pending:
+                            yield _delta_message(pending)
+                        yield _event_message(EventType.TOOL_CALL, {
+                            "message": {
+                                "id": tool_call_id,
+                                "content_type": ContentType.TOOL_CALL,
+                                "content": _json_str({
+                                    "name": tool_name,
+                                    "args": tool_args
+                                })
                             },
-                            event_id=event_id,
-                            event_type=EventType.TOOL_CALL
-                        )
-                        message_index += 1
+                            "status": MessageStatus.PENDING
+                        })
 
                 elif chunk["type"] == "tool_result":
                     # ✅ 更新时间线中对应工具调用的结果
                     tool_result_id = None
-                    for event in reversed(timeline):
-                        if event["type"] == "tool_call" and event["tool_name"] == chunk["tool_name"] and event.get("status") == "pending":
-                            event["result"] = chunk["result"]
-                            event["status"] = "success"
-                            tool_result_id = event.get("tool_id")
-
-                            # ✅ 更新数据库记录
-                            if tool_result_id and tool_result_id in tool_invocation_records:
-                                try:
-                                    invocation = tool_invocation_records[tool_result_id]
-                                    start_time_key = tool_result_id
-
-                                    # 计算耗时
-                                    duration_ms = None
-                                    if start_time_key in tool_start_times:
-                                        duration = (datetime.utcnow() - tool_start_times[start_time_key]).total_seconds()
-                                        duration_ms = int(duration * 1000)
-
-                                    # 解析工具返回结果，检查实际状态
-                                    # chunk["result"] 类型: Dict[str, Any]
-                                    # 格式: {"content": [{"type": "text", "text": "..."}], "isError": bool}
-                                    tool_result = chunk["result"]
-                                    tool_status = "success"
-                                    error_msg = None
-
-                                    if tool_result:
-                                        # MCP协议返回格式: {"content": [...], "isError": bool}
-                                        # 检查isError标志
-                                        if isinstance(tool_result, dict):
-                                            if tool_result.get("isError"):
-                                                tool_status = "failed"
-                                                # 从content中提取错误信息
-                                                content_list = tool_result.get("content", [])
-                                                if content_list and isinstance(content_list, list):
-                                                    error_msg = content_list[0].get("text", "Unknown error")
-
-                                            # 尝试解析content中的JSON，检查业务层的success标志
+                    pending_queue = pending_tool_calls.get(chunk["tool_name"])
+                    if pending_queue:
+                        event = pending_queue.popleft()  # ✅ 同名工具按调用顺序匹配结果
+                        event["result"] = chunk["result"]
+                        event["status"] = "success"
+                        tool_result_id = event.get("tool_id")
+
+                        # ✅ 更新数据库记录
+                        if tool_result_id and tool_result_id in tool_invocation_records:
+                            try:
+                                invocation = tool_invocation_records[tool_result_id]
+                                start_time_key = tool_result_id
+
+                                # 计算耗时
+                                duration_ms = None
+                                if start_time_key in tool_start_times:
+                                    duration = time.monotonic() - tool_start_times[start_time_key]
+                                    duration_ms = int(duration * 1000)
+
+                                # 解析工具返回结果，检查实际状态
+                                # chunk["result"] 类型: Dict[str, Any]
+                                # 格式: {"content": [{"type": "text", "text": "..."}], "isError": bool}
+                                tool_result = chunk["result"]
+                                tool_status = "success"
+                                error_msg = None
+
+                                if tool_result:
+                                    # MCP协议返回格式: {"content": [...], "isError": bool}
+                                    # 检查isError标志
+                                    if isinstance(tool_result, dict):
+                                        if tool_result.get("isError"):
+                                            tool_status = "failed"
+                                            # 从content中提取错误信息
                                             content_list = tool_result.get("content", [])
                                             if content_list and isinstance(content_list, list):
-                                                text_content = content_list[0].get("text", "")
-                                                try:
-                                                    inner_result = json.loads(text_content)
-                                                    if isinstance(inner_result, dict) and inner_result.get("success") is False:
-                                                        tool_status = "failed"
-                                                        error_msg = inner_result.get("error", error_msg or "Unknown error")
-                                                except (json.JSONDecodeError, ValueError, TypeError):
-                                                    pass
-
-                                        # 保存为JSONB格式
-                                        invocation.result = tool_result
-                                    else:
-                                        invocation.result = None
-
-                                    invocation.status = tool_status
-                                    invocation.error_message = error_msg
-                                    invocation.duration_ms = duration_ms
-
-                                    # 检查是否命中缓存（从result中判断）
-                                    # TODO: 如果MCP返回缓存标志，在这里更新
-
-                                    self.db.flush()
-
-                                    LOGGER.info(
-                                        f"✅ 更新工具调用记录: {invocation.tool_name} "
-                                        f"status={tool_status}, duration={duration_ms}ms"
-                                    )
-                                except Exception as e:
-                                    LOGGER.error(f"更新工具调用记录失败: {e}", exc_info=True)
-
-                            break
-
-                    event_id, current_event_type = self._get_next_event_id(
-                        EventType.TOOL_RESULT, current_event_type, event_id
-                    )
-                    yield self._wrap_ws_message(
-                        event_data={
-                            "message_id": str(assistant_message_id),
-                            "conversation_id": str(session_id),
-                            "message": {
-                                "id": tool_result_id or str(uuid4()),
-                                "content_type": ContentType.TOOL_RESULT,
-                                "content": json.dumps({
-                                    "name": chunk["tool_name"],
-                                    "result": chunk["result"]
-                                })
-                            },
-                            "status": MessageStatus.COMPLETED,
-                            "message_index": message_index
+                                                error_msg = content_list[0].get("text", "Unknown error")
+
+                                        # 尝试解析content中的JSON，检查业务层的success标志
+                                        content_list = tool_result.get("content", [])
+                                        if content_list and isinstance(content_list, list):
+                                            text_content = content_list[0].get("text", "")
+                                            try:
+                                                inner_result = orjson.loads(text_content)
+                                                if isinstance(inner_result, dict) and inner_result.get("success") is False:
+                                                    tool_status = "failed"
+                                                    error_msg = inner_result.get("error", error_msg or "Unknown error")
+                                            except (orjson.JSONDecodeError, ValueError, TypeError):
+                                                pass
+
+                                    # 保存为JSONB格式
+                                    invocation.result = tool_result
+                                else:
+                                    invocation.result = None
+
+                                invocation.status = tool_status
+                                invocation.error_message = error_msg
+                                invocation.duration_ms = duration_ms
+
+                                # 检查是否命中缓存（从result中判断）
+                                # TODO: 如果MCP返回缓存标志，在这里更新
+
+                                LOGGER.info(
+                                    f"✅ 更新工具调用记录: {invocation.tool_name} "
+                                    f"status={tool_status}, duration={duration_ms}ms"
+                                )
+                            except Exception as e:
+                                LOGGER.error(f"更新工具调用记录失败: {e}", exc_info=True)
+
+                    # ✅ 先发出缓冲中的增量，保证事件顺序
+                    pending = coalescer.flush()
+                    if pending:
+                        yield _delta_message(pending)
+                    yield _event_message(EventType.TOOL_RESULT, {
+                        "message": {
+                            "id": tool_result_id or str(uuid4()),
+                            "content_type": ContentType.TOOL_RESULT,
+                            "content": _json_str({
+                                "name": chunk["tool_name"],
+                                "result": chunk["result"]
+                            })
                         },
-                        event_id=event_id,
-                        event_type=EventType.TOOL_RESULT
-                    )
-                    message_index += 1
+                        "status": MessageStatus.COMPLETED
+                    })
 
                 elif chunk["type"] == "llm_invocation":
                     # ✅ LLM调用完成事件
@@ -1450,32 +2135,25 @@ class ChatService:
                     if model_max_context > 0:
                         context_usage_percent = round((session.total_tokens / model_max_context) * 100, 2)
 
+                    # ✅ 先发出缓冲中的增量，保证事件顺序
+                    pending = coalescer.flush()
+                    if pending:
+                        yield _delta_message(pending)
                     # 推送LLM调用完成事件
-                    event_id, current_event_type = self._get_next_event_id(
-                        EventType.LLM_INVOCATION_COMPLETE, current_event_type, event_id
-                    )
-                    yield self._wrap_ws_message(
-                        event_data={
-                            "message_id": str(assistant_message_id),
-                            "conversation_id": str(session_id),
-                            "invocation": {
-                                "sequence": invocation_data.get('sequence'),
-                                "tokens": {
-                                    "prompt": invocation_data.get('prompt_tokens'),
-                                    "completion": invocation_data.get('completion_tokens'),
-                                    "total": invocation_data.get('total_tokens')
-                                },
-                                "duration_ms": invocation_data.get('duration_ms'),
-                                "finish_reason": invocation_data.get('finish_reason')
+                    yield _event_message(EventType.LLM_INVOCATION_COMPLETE, {
+                        "invocation": {
+                            "sequence": invocation_data.get('sequence'),
+                            "tokens": {
+                                "prompt": invocation_data.get('prompt_tokens'),
+                                "completion": invocation_data.get('completion_tokens'),
+                                "total": invocation_data.get('total_tokens')
                             },
-                            "session_cumulative_tokens": session.total_tokens,
-                            "context_usage_percent": context_usage_percent,
-                            "message_index": message_index
+                            "duration_ms": invocation_data.get('duration_ms'),
+                            "finish_reason": invocation_data.get('finish_reason')
                         },
-                        event_id=event_id,
-                        event_type=EventType.LLM_INVOCATION_COMPLETE
-                    )
-                    message_index += 1
+                        "session_cumulative_tokens": session.total_tokens,
+                        "context_usage_percent": context_usage_percent
+                    })
 
                 elif chunk["type"] == "usage":
                     # ✅ Token 统计信息（最终汇总，保留用于兼容）
@@ -1484,61 +2162,64 @@ class ChatService:
                     completion_tokens = usage.get("completion_tokens", 0)
                     total_tokens = usage.get("total_tokens", 0)
 
+            # 流结束时暂缓确认的末尾字符（半个 <think> / </think>）按当前模式作为正文或 thinking 发出
+            for kind, text in think_splitter.finish():
+                if kind == _SEG_CONTENT:
+                    content_parts.append(text)
+                    for batch in coalescer.push(_EV_CONTENT, None, text):
+                        yield _delta_message(batch)
+                else:
+                    thinking_parts.append(text)
+                    for batch in coalescer.push(_EV_THINKING_DELTA, current_thinking_id, text):
+                        yield _delta_message(batch)
+            # ✅ 先发出缓冲中的增量，保证事件顺序
+            pending = coalescer.flush()
+            if pending:
+                yield _delta_message(pending)
             # 生成完成，保存助手消息
-            generation_time = (datetime.utcnow() - start_time).total_seconds()
+            # 流结束时仍处于 thinking 模式：已确认的片段（含上面补发的末尾字符）就是完整内容
+            if current_thinking_id:
+                current_thinking = "".join(thinking_parts)
+            assistant_content = "".join(content_parts)
+            generation_time = time.monotonic() - start_monotonic
+            finished_at = datetime.utcnow()  # ✅ 收尾阶段统一使用的时间戳（只取一次）
 
             # ✅ 如果有未完成的 thinking，发送完成事件并保存到 timeline
-            if thinking_buffer and current_thinking_id:
+            if current_thinking and current_thinking_id:
                 # 保存到 timeline
                 timeline.append({
                     "type": "thinking",
-                    "content": thinking_buffer.strip(),
+                    "content": current_thinking.strip(),
                     "thinking_id": current_thinking_id,
-                    "timestamp": datetime.utcnow().isoformat()
+                    "timestamp": finished_at.isoformat()
                 })
 
                 # 🔧 发送 THINKING_COMPLETE 事件（修复：流结束时未完成的思考也要发送完成事件）
-                event_id, current_event_type = self._get_next_event_id(
-                    EventType.THINKING_COMPLETE, current_event_type, event_id
-                )
-                yield self._wrap_ws_message(
-                    event_data={
-                        "message_id": str(assistant_message_id),
-                        "conversation_id": str(session_id),
-                        "message": {
-                            "id": current_thinking_id,
-                            "content_type": ContentType.THINKING,
-                            "content": json.dumps({"finish_title": "已完成思考"})
-                        },
-                        "status": MessageStatus.COMPLETED,
-                        "is_finish": True,
-                        "message_index": message_index
+                yield _event_message(EventType.THINKING_COMPLETE, {
+                    "message": {
+                        "id": current_thinking_id,
+                        "content_type": ContentType.THINKING,
+                        "content": _THINKING_COMPLETE_CONTENT
                     },
-                    event_id=event_id,
-                    event_type=EventType.THINKING_COMPLETE
-                )
-                message_index += 1
-            elif thinking_buffer and not has_sent_thinking:
-                # 兼容旧逻辑：没有 thinking_id 的情况
-                timeline.insert(0, {
-                    "type": "thinking",
-                    "content": thinking_buffer.strip(),
-                    "timestamp": start_time.isoformat()
+                    "status": MessageStatus.COMPLETED,
+                    "is_finish": True
                 })
 
             # ✅ 根据timeline保存独立消息（新格式，符合OpenAI标准）
             # 🎯 关键改进：使用round_id标识同一轮对话
             # 所有消息使用统一的时间戳和round_id，确保排序正确且不会被摘要切割
-            messages_timestamp = datetime.utcnow()
+            messages_timestamp = finished_at
             round_id = assistant_message_id  # ✅ 使用assistant_message_id作为round_id
             display_order_counter = 0
+            turn_llm_messages = []  # ✅ 本轮产生的LLM上下文消息（用于更新上下文缓存）
+            turn_rows = []  # ✅ 本轮拆分出的独立消息（thinking/tool_call/tool_result），最后批量插入
 
             for event in timeline:
                 event_type = event.get("type")
 
                 # 1. 保存thinking消息
                 if event_type == "thinking":
-                    thinking_msg = ChatMessage(
+                    turn_rows.append(dict(
                         message_id=uuid4(),  # 每条消息独立的UUID
                         round_id=round_id,  # ✅ 同一轮对话共享round_id
                         session_id=session_id,
@@ -1552,14 +2233,13 @@ class ChatService:
                         model_name=model_config.model_id,
                         created_at=messages_timestamp,  # ✅ 统一时间戳
                         sent_at=messages_timestamp
-                    )
-                    self.db.add(thinking_msg)
+                    ))
                     display_order_counter += 1
                     LOGGER.debug(f"💭 保存thinking消息: {len(event['content'])} 字符")
 
                 # 2. 保存tool_call消息（assistant发起工具调用）
                 elif event_type == "tool_call":
-                    tool_call_msg = ChatMessage(
+                    turn_rows.append(dict(
                         message_id=uuid4(),  # 每条消息独立的UUID
                         round_id=round_id,  # ✅ 同一轮对话共享round_id
                         session_id=session_id,
@@ -1570,7 +2250,7 @@ class ChatService:
                             "type": "function",
                             "function": {
                                 "name": event["tool_name"],
-                                "arguments": json.dumps(event["tool_args"], ensure_ascii=False)
+                                "arguments": event["tool_args"] if isinstance(event["tool_args"], str) else _json_str(event["tool_args"])
                             }
                         }],
                         message_type="text",
@@ -1581,9 +2261,20 @@ class ChatService:
                         model_name=model_config.model_id,
                         created_at=messages_timestamp,  # ✅ 统一时间戳
                         sent_at=messages_timestamp
-                    )
-                    self.db.add(tool_call_msg)
+                    ))
                     display_order_counter += 1
+                    turn_llm_messages.append({
+                        "role": "assistant",
+                        "content": "",
+                        "tool_calls": [{
+                            "id": event["tool_id"],
+                            "type": "function",
+                            "function": {
+                                "name": event["tool_name"],
+                                "arguments": event["tool_args"]
+                            }
+                        }]
+                    })
 
                     # 3. 保存tool_result消息（如果有结果）
                     if event.get("result"):
@@ -1595,11 +2286,11 @@ class ChatService:
                             if content_list and isinstance(content_list, list):
                                 result_content = content_list[0].get("text", "")
                             else:
-                                result_content = json.dumps(tool_result, ensure_ascii=False)
+                                result_content = _json_str(tool_result)
                         else:
-                            result_content = json.dumps(tool_result, ensure_ascii=False)
+                            result_content = _json_str(tool_result)
 
-                        tool_result_msg = ChatMessage(
+                        turn_rows.append(dict(
                             message_id=uuid4(),  # 每条消息独立的UUID
                             round_id=round_id,  # ✅ 同一轮对话共享round_id
                             session_id=session_id,
@@ -1614,21 +2305,24 @@ class ChatService:
                             display_order=display_order_counter,
                             created_at=messages_timestamp,  # ✅ 统一时间戳
                             sent_at=messages_timestamp
-                        )
-                        self.db.add(tool_result_msg)
+                        ))
                         display_order_counter += 1
+                        turn_llm_messages.append({
+                            "role": "tool",
+                            "tool_call_id": event["tool_id"],
+                            "name": event["tool_name"],
+                            "content": result_content
+                        })
                         LOGGER.debug(f"🔧 保存tool消息: {event['tool_name']}, 结果长度={len(result_content)}")
 
-            # ✅ 废弃 structured_content.timeline（新消息不再使用）
-            structured_content = None
-
             # ✅ 更新占位符消息（最终的assistant回复）
             # 重要：使用与独立消息相同的时间戳和round_id，确保按display_order排序
             assistant_message_placeholder.round_id = round_id  # ✅ 设置round_id
             assistant_message_placeholder.content = assistant_content
             assistant_message_placeholder.status = "completed"
             assistant_message_placeholder.generation_time = generation_time
-            assistant_message_placeholder.structured_content = structured_content
+            # ✅ structured_content.timeline 已废弃（timeline 拆分为独立消息保存），不再赋值：
+            # 对 JSONB 列显式赋 None 会编码并写入 JSON 'null'，不赋值则保持插入时的 SQL NULL
             assistant_message_placeholder.message_subtype = "final_response"  # 标记为最终回复
             assistant_message_placeholder.display_order = display_order_counter
             assistant_message_placeholder.created_at = messages_timestamp  # ✅ 与独立消息相同时间戳
@@ -1637,77 +2331,86 @@ class ChatService:
             assistant_message_placeholder.completion_tokens = completion_tokens
             assistant_message_placeholder.total_tokens = total_tokens
 
-            assistant_message = assistant_message_placeholder
-
             LOGGER.info(f"✅ 保存完整消息链: {display_order_counter + 1} 条消息（含thinking/tool_call/tool_result/final_response）")
 
             # ✅ 更新会话的 current_context_tokens 和 total_tokens
-            session.current_context_tokens = self.calculate_current_context_tokens(session_id)
+            # 下一轮的上下文 = 本条回复的 total_tokens（与 _context_tokens_query 的口径一致），
+            # 直接用内存中的统计值，无需再查询最新的助手消息；没有 usage 统计时保留原值
+            # ⚠️ 后台摘要待生效时不写回：本轮统计的是摘要前的上下文，会覆盖摘要任务重置后的值
+            if total_tokens and not summary_pending:
+                session.current_context_tokens = total_tokens
             # session.total_tokens 已经在每次LLM调用时累加了，这里不需要重复设置
 
-            # ✅ 一次性提交所有更改（消息、invocations、session）
-            self.db.commit()
-
-            LOGGER.info(f"✅ 会话统计更新: current_context={session.current_context_tokens}/{model_max_context} tokens ({session.current_context_tokens/model_max_context*100:.1f}%), total_tokens={session.total_tokens}")
+            # ✅ 提交前先取出完成事件需要的会话统计（提交后属性会过期，再访问会触发 refresh 查询）
+            current_context_tokens = session.current_context_tokens
+            session_total_tokens = session.total_tokens
+            session_message_count = session.message_count
+            last_activity_at = session.last_activity_at
 
-            # ✅ 清除会话摘要缓存（会话内容已更新）
-            redis_service.delete_session_summary(str(session_id))
+            # ✅ 一次性提交所有更改（消息、invocations、session）
+            # 同步的批量插入和 commit 放到线程中执行，避免阻塞事件循环上的其他连接
+            if turn_rows:
+                await asyncio.to_thread(self.create_messages_bulk, turn_rows)
+            await asyncio.to_thread(self.db.commit)
+
+            LOGGER.info(f"✅ 会话统计更新: current_context={current_context_tokens}/{model_max_context} tokens ({current_context_tokens/model_max_context*100:.1f}%), total_tokens={session_total_tokens}")
+
+            # ✅ 清除会话摘要缓存（会话内容已更新），后台执行，不阻塞完成事件
+            _run_in_background(redis_service.delete_session_summary, session_id_str)
+
+            # ✅ 结束本轮并缓存本轮结束后的LLM上下文，下一轮直接追加用户消息即可
+            # 后台摘要进行中（摘要完成后上下文会变化）或与其他轮次重叠时不写回，缓存被删除，下一轮从数据库重建
+            turn_llm_messages.append({"role": "assistant", "content": assistant_content})
+            context_turn_ended = True
+            await asyncio.to_thread(
+                redis_service.end_session_turn,
+                session_id_str,
+                context_turn,
+                messages + turn_llm_messages if context_exclusive and not summary_pending else None
+            )
 
             # 发送done消息，使用数据库中的真实message_id
-            event_id, current_event_type = self._get_next_event_id(
-                EventType.MESSAGE_DONE, current_event_type, event_id
-            )
-            yield self._wrap_ws_message(
-                event_data={
-                    "message_id": assistant_message.message_id,  # 使用业务ID
-                    "conversation_id": str(session_id),
-                    "status": MessageStatus.COMPLETED,
-                    "is_finish": True,
-                    "message_index": message_index,
-                    "generation_time": generation_time,
-                    # ✅ 推送上下文信息，前端直接使用，无需额外请求
-                    "context_info": {
-                        "current_context_tokens": session.current_context_tokens,
-                        "max_context_tokens": model_max_context
-                    },
-                    # ✅ 推送会话统计信息，用于更新会话列表显示
-                    "session_info": {
-                        "session_id": str(session_id),
-                        "message_count": session.message_count,  # ✅ 总消息数（包括用户和助手）
-                        "total_prompt_tokens": prompt_tokens,  # ✅ 当前对话的 prompt tokens
-                        "total_completion_tokens": completion_tokens,  # ✅ 当前对话的 completion tokens
-                        "total_tokens": session.total_tokens,  # ✅ 会话累计 tokens
-                        "last_activity_at": session.last_activity_at.isoformat() if session.last_activity_at else None
-                    }
+            yield _event_message(EventType.MESSAGE_DONE, {
+                "status": MessageStatus.COMPLETED,
+                "is_finish": True,
+                "generation_time": generation_time,
+                # ✅ 推送上下文信息，前端直接使用，无需额外请求
+                "context_info": {
+                    "current_context_tokens": current_context_tokens,
+                    "max_context_tokens": model_max_context
                 },
-                event_id=event_id,
-                event_type=EventType.MESSAGE_DONE
-            )
+                # ✅ 推送会话统计信息，用于更新会话列表显示
+                "session_info": {
+                    "session_id": session_id_str,
+                    "message_count": session_message_count,  # ✅ 总消息数（包括用户和助手）
+                    "total_prompt_tokens": prompt_tokens,  # ✅ 当前对话的 prompt tokens
+                    "total_completion_tokens": completion_tokens,  # ✅ 当前对话的 completion tokens
+                    "total_tokens": session_total_tokens,  # ✅ 会话累计 tokens
+                    "last_activity_at": last_activity_at.isoformat() if last_activity_at else None
+                }
+            })
 
             # 如果是第一条消息，异步生成标题
-            if session.message_count == 2:  # 用户消息 + AI回复
+            if session_message_count == 2:  # 用户消息 + AI回复
                 # ✅ 异步生成会话标题（不阻塞响应）并推送给前端
-                import asyncio
-                asyncio.create_task(self.generate_title(session_id, str(user.id)))
+                enqueue_title_generation(session_id_str, str(user.id))
 
         except Exception as e:
             LOGGER.exception("生成回复失败")
-            yield self._wrap_ws_message(
-                event_data={
-                        "message_id": str(assistant_message_id),
-                        "conversation_id": str(session_id),
-                    "message": {
-                        "id": str(uuid4()),
-                        "content_type": ContentType.ERROR,
-                        "content": json.dumps({"error": str(e)})
-                    },
-                    "status": MessageStatus.ERROR,
-                    "is_finish": True,
-                    "message_index": message_index
+            yield _event_message(EventType.ERROR, {
+                "message": {
+                    "id": assistant_message_id_str,  # ✅ 复用本次回复的ID，无需再生成UUID
+                    "content_type": ContentType.ERROR,
+                    "content": _json_str({"error": str(e)})
                 },
-                event_id=event_id,
-                event_type=EventType.ERROR
-            )
+                "status": MessageStatus.ERROR,
+                "is_finish": True
+            })
+
+        finally:
+            # ✅ 出错或被中断（停止生成/断开连接）时也要结束本轮（不写回缓存），后台执行
+            if not context_turn_ended:
+                _run_in_background(redis_service.end_session_turn, session_id_str, context_turn)
 
         # ✅ 不需要关闭 client，由 factory 统一管理连接池
 
@@ -1794,7 +2497,7 @@ class ChatService:
 
             # 推送给前端
             await manager.send_message(user_id, {
-                "event_data": json.dumps(event_data, ensure_ascii=False, default=str),
+                "event_data": orjson.dumps(event_data, default=str),
                 "event_id": "0",
                 "event_type": EventType.SESSION_TITLE_UPDATED
             })
@@ -1821,11 +2524,15 @@ class ChatService:
         Returns:
             生成的标题
         """
+        # ✅ 只取对话开头的片段生成标题：先截断再单次 translate 归一化空白，不处理整段长回复
+        user_excerpt = user_message[:_TITLE_USER_CHARS].translate(_TITLE_WS_TABLE).strip()
+        assistant_excerpt = assistant_message[:_TITLE_ASSISTANT_CHARS].translate(_TITLE_WS_TABLE).strip()
+
         # 构建标题生成提示词
         title_prompt = f"""请根据以下对话内容，生成一个简洁明了的标题（8-15字以内，不要使用标点符号）。
 
-用户问题：{user_message}
-AI回复：{assistant_message}...
+用户问题：{user_excerpt}
+AI回复：{assistant_excerpt}...
 
 要求：
 1. 提取对话的核心主题
@@ -1862,18 +2569,17 @@ AI回复：{assistant_message}...
 
             # 移除思考标签（如果LLM返回了）
             if '<think>' in title:
-                title = title.split('</think>')[-1].strip()
+                title = title.rpartition('</think>')[2].strip()
 
             # 清理可能的引号、标点等（首尾）
             title = title.strip('"\'「」《》『』【】""''。，！？、;：')
 
             # 如果LLM返回了多行，只取第一行
             if '\n' in title:
-                title = title.split('\n')[0].strip()
+                title = title.partition('\n')[0].strip()
 
             # 移除可能的"标题："前缀
-            if title.startswith('标题：') or title.startswith('标题:'):
-                title = title[3:].strip()
+            title = _TITLE_PREFIX_RE.sub('', title, count=1)
 
             # 如果标题为空或太短，使用通用标题
             if not title or len(title) < 2:
@@ -1895,3 +2601,116 @@ AI回复：{assistant_message}...
         # 注意：不要关闭客户端，因为是从 FACTORY 缓存获取的共享实例
 
 
+# ==================== 后台任务 ====================
+
+_BACKGROUND_TASKS = set()  # 持有后台任务的强引用，防止任务未完成就被回收
+
+
+def _run_in_background(func, *args):
+    """在线程中后台执行同步函数（如 Redis 操作），不等待结果
+
+    Args:
+        func: 同步函数
+        *args: 函数参数
+    """
+    task = asyncio.create_task(asyncio.to_thread(func, *args))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
+# ==================== 会话摘要后台生成 ====================
+
+_SUMMARY_IN_FLIGHT = set()  # 正在后台生成摘要的会话ID，同一会话同时只运行一个摘要任务
+
+
+async def _summary_task(session_id: str, user_id):
+    """后台生成会话摘要，使用独立的数据库会话
+
+    Args:
+        session_id: 会话ID
+        user_id: 用户ID
+    """
+    db = SESSION_LOCAL()
+    try:
+        # ✅ 同步数据库操作都在线程中执行，不阻塞事件循环
+        user = await asyncio.to_thread(db.get, User, user_id)
+        if user:
+            await ChatService(db).generate_session_summary(session_id, user)
+    except Exception:
+        LOGGER.exception("后台生成会话摘要失败: session_id=%s", session_id)
+    finally:
+        await asyncio.to_thread(db.close)
+        _SUMMARY_IN_FLIGHT.discard(session_id)
+
+
+def _schedule_session_summary(session_id: str, user_id) -> bool:
+    """把会话摘要生成放到后台执行（不阻塞当前轮次）
+
+    Args:
+        session_id: 会话ID
+        user_id: 用户ID
+
+    Returns:
+        是否新建了摘要任务（该会话已有摘要任务在运行时返回False）
+    """
+    if session_id in _SUMMARY_IN_FLIGHT:
+        return False
+    _SUMMARY_IN_FLIGHT.add(session_id)
+    task = asyncio.create_task(_summary_task(session_id, user_id))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return True
+
+
+# ==================== 会话标题生成后台队列 ====================
+
+_TITLE_QUEUE: Optional[asyncio.Queue] = None
+_TITLE_WORKER: Optional[asyncio.Task] = None
+
+
+async def _title_worker():
+    """标题生成后台 worker：串行处理队列中的会话，每个任务使用独立的数据库会话"""
+    while True:
+        session_id, user_id = await _TITLE_QUEUE.get()
+        db = SESSION_LOCAL()
+        try:
+            await ChatService(db).generate_title(session_id, user_id)
+        except Exception:
+            LOGGER.exception("后台生成会话标题失败: session_id=%s", session_id)
+        finally:
+            db.close()
+            _TITLE_QUEUE.task_done()
+
+
+def start_title_worker():
+    """启动标题生成后台 worker（应用启动时调用，重复调用无副作用）"""
+    global _TITLE_QUEUE, _TITLE_WORKER  # pylint: disable=global-statement
+    if _TITLE_WORKER is not None and not _TITLE_WORKER.done():
+        return
+    if _TITLE_QUEUE is None:
+        _TITLE_QUEUE = asyncio.Queue()
+    _TITLE_WORKER = asyncio.create_task(_title_worker())
+
+
+async def stop_title_worker():
+    """停止标题生成后台 worker（应用关闭时调用）"""
+    global _TITLE_WORKER  # pylint: disable=global-statement
+    if _TITLE_WORKER is None:
+        return
+    _TITLE_WORKER.cancel()
+    try:
+        await _TITLE_WORKER
+    except asyncio.CancelledError:
+        pass
+    _TITLE_WORKER = None
+
+
+def enqueue_title_generation(session_id: str, user_id: Optional[str] = None):
+    """把会话加入标题生成队列（不阻塞调用方）
+
+    Args:
+        session_id: 会话ID
+        user_id: 用户ID（用于WebSocket推送）
+    """
+    start_title_worker()  # ✅ 兜底：未在启动时初始化（如脚本调用）时按需启动
+    _TITLE_QUEUE.put_nowait((session_id, user_id))
@@ -0,0 +1,92 @@
+"""测试会话LLM上下文缓存的轮次协议（begin_session_turn / end_session_turn），需要可用的 Redis"""
+
+from uuid import uuid4
+
+import pytest
+
+from app.core.redis_client import RedisService
+
+pytestmark = pytest.mark.skipif(not RedisService().ping(), reason="需要可用的 Redis")
+
+CONTEXT = [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好！"}]
+
+
+@pytest.fixture
+def service():
+    """Redis服务"""
+    return RedisService()
+
+
+@pytest.fixture
+def session_id(service):
+    """随机会话ID（测试结束后清理相关键）"""
+    sid = str(uuid4())
+    yield sid
+    service.client.delete(f"session_ctx:{sid}", f"session_turn:{sid}", f"session_active:{sid}")
+
+
+def _active_count(service: RedisService, session_id: str) -> int:
+    """正在进行的轮次数"""
+    return int(service.client.get(f"session_active:{session_id}") or 0)
+
+
+def test_exclusive_turn_writes_back_context(service, session_id):
+    """独占的一轮结束后写回缓存，下一轮可以取到"""
+    cached, turn, exclusive = service.begin_session_turn(session_id)
+    assert cached is None
+    assert exclusive
+
+    assert service.end_session_turn(session_id, turn, CONTEXT)
+
+    cached, turn, exclusive = service.begin_session_turn(session_id)
+    assert exclusive
+    assert cached == CONTEXT
+    service.end_session_turn(session_id, turn)
+
+
+def test_overlapping_turn_does_not_write_back_stale_context(service, session_id):
+    """先开始的一轮在另一轮开始后才结束，不写回基于旧历史的上下文"""
+    service.end_session_turn(session_id, service.begin_session_turn(session_id)[1], CONTEXT)
+
+    cached_a, turn_a, exclusive_a = service.begin_session_turn(session_id)
+    cached_b, turn_b, exclusive_b = service.begin_session_turn(session_id)
+    assert cached_a == CONTEXT and exclusive_a
+    assert cached_b is None and not exclusive_b  # 重叠的一轮不使用缓存
+
+    stale = CONTEXT + [{"role": "user", "content": "A"}, {"role": "assistant", "content": "A的回答"}]
+    assert not service.end_session_turn(session_id, turn_a, stale)
+    assert not service.end_session_turn(session_id, turn_b)  # 非独占的一轮由调用方传 None
+
+    assert service.client.get(f"session_ctx:{session_id}") is None
+    assert _active_count(service, session_id) == 0
+
+
+def test_delete_session_context_invalidates_in_flight_turn(service, session_id):
+    """进行中的一轮期间上下文被删除（编辑/删除消息、生成摘要），结束时不再写回"""
+    _, turn, exclusive = service.begin_session_turn(session_id)
+    assert exclusive
+
+    service.delete_session_context(session_id)
+
+    assert not service.end_session_turn(session_id, turn, CONTEXT)
+    assert service.client.get(f"session_ctx:{session_id}") is None
+
+    cached, turn, exclusive = service.begin_session_turn(session_id)
+    assert cached is None and exclusive
+    service.end_session_turn(session_id, turn)
+
+
+def test_active_count_returns_to_zero_on_error_path(service, session_id):
+    """出错/被中断的一轮不写回缓存，结束后进行中的轮次数归零，下一轮仍是独占的"""
+    service.end_session_turn(session_id, service.begin_session_turn(session_id)[1], CONTEXT)
+
+    _, turn, _ = service.begin_session_turn(session_id)
+    assert _active_count(service, session_id) == 1
+
+    assert not service.end_session_turn(session_id, turn)  # 出错路径：messages=None
+    assert _active_count(service, session_id) == 0
+    assert service.client.get(f"session_ctx:{session_id}") is None  # 缓存已在开始时取出，不会残留
+
+    cached, turn, exclusive = service.begin_session_turn(session_id)
+    assert cached is None and exclusive
+    service.end_session_turn(session_id, turn)
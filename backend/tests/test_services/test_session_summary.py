@@ -0,0 +1,147 @@
+"""测试会话摘要的后台触发：上下文超过阈值的连续两轮只生成一次摘要"""
+
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+from uuid import uuid4
+
+import pytest
+
+from app.db.session import SESSION_LOCAL
+from app.models.chat import ChatMessage
+from app.models.session import ChatSession
+from app.models.user import User
+from app.services import chat_service as chat_service_module
+from app.services.chat_service import ChatService, ModelConfig
+
+MAX_CONTEXT = 1000
+ROUNDS = 8  # 超过保留的最近5组，才会真正生成摘要
+
+MODEL_CONFIG = ModelConfig(
+    model_id="qwen3:8b",
+    provider="ollama",
+    base_url=None,
+    max_tokens=None,
+    max_context_length=MAX_CONTEXT,
+    supports_streaming=True,
+    supports_tools=False,
+)
+
+
+class FakeSummaryClient:
+    """替代 LLM 客户端，返回固定的摘要内容"""
+
+    async def chat(self, messages, stream=False):
+        """返回固定摘要"""
+        return {"content": "用户和助手讨论了若干话题"}
+
+
+@pytest.fixture
+def db():
+    """数据库会话"""
+    session = SESSION_LOCAL()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def chat_session(db):
+    """创建上下文已超过阈值、包含多轮对话的会话（测试结束后级联删除）"""
+    suffix = uuid4().hex[:8]
+    user = User(
+        username=f"summary_test_{suffix}",
+        email=f"summary_test_{suffix}@example.com",
+        password_hash="x"
+    )
+    db.add(user)
+    db.flush()
+
+    session = ChatSession(
+        session_id=uuid4(),
+        user_id=user.id,
+        title="摘要测试",
+        status="active",
+        ai_model=MODEL_CONFIG.model_id,
+        current_context_tokens=MAX_CONTEXT,
+    )
+    db.add(session)
+    db.flush()
+
+    start = datetime.utcnow() - timedelta(hours=1)
+    for i in range(ROUNDS):
+        round_id = uuid4()
+        db.add(ChatMessage(
+            message_id=round_id,
+            round_id=round_id,
+            session_id=session.session_id,
+            role="user",
+            content=f"第{i}轮问题",
+            message_type="text",
+            status="completed",
+            created_at=start + timedelta(minutes=i),
+        ))
+        db.add(ChatMessage(
+            message_id=uuid4(),
+            round_id=round_id,
+            session_id=session.session_id,
+            role="assistant",
+            content=f"第{i}轮回答",
+            message_type="text",
+            status="completed",
+            total_tokens=MAX_CONTEXT,
+            created_at=start + timedelta(minutes=i, seconds=1),
+        ))
+    db.commit()
+
+    yield session
+
+    db.rollback()
+    db.query(User).filter(User.id == user.id).delete()  # 会话和消息由外键级联删除
+    db.commit()
+
+
+def _count_summaries(db, session: ChatSession) -> int:
+    """统计会话中未删除的摘要消息数"""
+    return db.query(ChatMessage).filter(
+        ChatMessage.session_id == session.session_id,
+        ChatMessage.is_summary == True,  # noqa: E712
+        ChatMessage.is_deleted == False  # noqa: E712
+    ).count()
+
+
+@pytest.fixture
+def fake_backends():
+    """替换模型配置、LLM 客户端和 Redis（摘要逻辑只依赖数据库）"""
+    with patch.object(ChatService, "get_model_by_id", return_value=MODEL_CONFIG), \
+            patch.object(chat_service_module.FACTORY, "create_client", return_value=FakeSummaryClient()), \
+            patch.object(chat_service_module, "redis_service", MagicMock()):
+        yield
+
+
+@pytest.mark.asyncio
+async def test_consecutive_turns_over_threshold_summarize_once(db, chat_session, fake_backends):
+    """摘要完成后重置上下文token，下一轮不再触发摘要"""
+    service = ChatService(db)
+
+    triggered = []
+    for _ in range(2):
+        db.refresh(chat_session)  # 每轮开始时重新读取会话（对应 send_message_streaming 的 get_session）
+        triggered.append(service._schedule_summary_if_needed(chat_session, MAX_CONTEXT))
+        await asyncio.gather(*list(chat_service_module._BACKGROUND_TASKS))
+
+    db.refresh(chat_session)
+    assert triggered == [True, False]
+    assert _count_summaries(db, chat_session) == 1
+    assert chat_session.current_context_tokens < int(MAX_CONTEXT * 0.9)
+
+
+@pytest.mark.asyncio
+async def test_overlapping_turns_over_threshold_summarize_once(db, chat_session, fake_backends):
+    """摘要完成前到达的下一轮不会重复启动摘要任务"""
+    service = ChatService(db)
+
+    assert service._schedule_summary_if_needed(chat_session, MAX_CONTEXT)
+    assert service._schedule_summary_if_needed(chat_session, MAX_CONTEXT)
+    await asyncio.gather(*list(chat_service_module._BACKGROUND_TASKS))
+
+    assert _count_summaries(db, chat_session) == 1
@@ -0,0 +1,171 @@
+"""测试流式回复的解析：<think> 标签拆分（_ThinkTagSplitter / _partial_tag_len）和增量合并（_DeltaCoalescer）"""
+
+import pytest
+
+from app.services import chat_service as chat_service_module
+from app.services.chat_service import (
+    _SEG_CONTENT,
+    _SEG_THINK_CLOSE,
+    _SEG_THINK_OPEN,
+    _SEG_THINKING,
+    _DeltaCoalescer,
+    _ThinkTagSplitter,
+    _partial_tag_len,
+)
+
+EV_CONTENT = 1
+EV_THINKING = 2
+
+
+def _split(chunks):
+    """把 chunk 依次送入拆分器，合并相邻的同类文本片段，便于与期望结果比较"""
+    splitter = _ThinkTagSplitter()
+    segments = []
+    for chunk in chunks:
+        segments.extend(splitter.feed(chunk))
+    segments.extend(splitter.finish())
+
+    merged = []
+    for kind, text in segments:
+        if merged and kind in (_SEG_CONTENT, _SEG_THINKING) and merged[-1][0] == kind:
+            merged[-1] = (kind, merged[-1][1] + text)
+        else:
+            merged.append((kind, text))
+    return merged
+
+
+@pytest.mark.parametrize("text, tag, expected", [
+    ("你好", "</think>", 0),
+    ("你好<", "</think>", 1),
+    ("你好</thi", "</think>", 5),
+    ("你好</think", "</think>", 7),
+    ("你好</think>", "</think>", 0),  # 完整标签由 find 处理，不属于“半个标签”
+    ("<th", "<think>", 3),
+    ("a<b", "<think>", 0),
+    ("", "<think>", 0),
+])
+def test_partial_tag_len(text, tag, expected):
+    """末尾与标签前缀重合的长度"""
+    assert _partial_tag_len(text, tag) == expected
+
+
+FULL_TEXT = "前言<think>先想一想</think>正文"
+FULL_EXPECTED = [
+    (_SEG_CONTENT, "前言"),
+    (_SEG_THINK_OPEN, ""),
+    (_SEG_THINKING, "先想一想"),
+    (_SEG_THINK_CLOSE, ""),
+    (_SEG_CONTENT, "正文"),
+]
+
+
+@pytest.mark.parametrize("cut", range(1, len(FULL_TEXT)))
+def test_tags_split_at_every_boundary(cut):
+    """标签被拆在任意两个 chunk 之间时，结果与整段到达相同"""
+    assert _split([FULL_TEXT[:cut], FULL_TEXT[cut:]]) == FULL_EXPECTED
+
+
+def test_tags_split_into_single_characters():
+    """逐字到达时结果与整段到达相同"""
+    assert _split(list(FULL_TEXT)) == FULL_EXPECTED
+    assert _split([FULL_TEXT]) == FULL_EXPECTED
+
+
+@pytest.mark.parametrize("chunks", [
+    ["a < b"],
+    ["a <", " b"],
+    ["x<thin", "g>y"],
+    ["1 <= 2 <th"],  # 末尾半个 <think> 在流结束时作为正文发出
+    ["<", "/think>"],  # 正文模式下的 </think> 只是普通文本
+])
+def test_angle_bracket_that_is_not_a_tag(chunks):
+    """含 "<" 但不构成 <think> 的文本全部作为正文"""
+    assert _split(chunks) == [(_SEG_CONTENT, "".join(chunks))]
+
+
+def test_lt_inside_thinking_is_kept():
+    """thinking 中不构成 </think> 的 "<" 保留在 thinking 文本中"""
+    assert _split(["<think>a<", "b</", "c</think>"]) == [
+        (_SEG_THINK_OPEN, ""),
+        (_SEG_THINKING, "a<b</c"),
+        (_SEG_THINK_CLOSE, ""),
+    ]
+
+
+@pytest.mark.parametrize("chunks", [
+    ["<think>未完成的思考</thi"],
+    ["<think>未完成的思考</", "thi"],
+    ["<thi", "nk>未完成的思考</thi"],
+])
+def test_unclosed_think_at_eof(chunks):
+    """流结束时 thinking 未闭合：暂缓确认的半个 </think> 作为 thinking 文本发出，不产生结束片段"""
+    assert _split(chunks) == [
+        (_SEG_THINK_OPEN, ""),
+        (_SEG_THINKING, "未完成的思考</thi"),
+    ]
+
+
+def test_multiple_think_blocks():
+    """多轮思考"""
+    assert _split(["<think>一</think>甲<think>", "二</think>乙"]) == [
+        (_SEG_THINK_OPEN, ""),
+        (_SEG_THINKING, "一"),
+        (_SEG_THINK_CLOSE, ""),
+        (_SEG_CONTENT, "甲"),
+        (_SEG_THINK_OPEN, ""),
+        (_SEG_THINKING, "二"),
+        (_SEG_THINK_CLOSE, ""),
+        (_SEG_CONTENT, "乙"),
+    ]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可手动推进的单调时钟"""
+    now = [1000.0]
+    monkeypatch.setattr(chat_service_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_coalescer_flushes_when_window_expires(clock):
+    """窗口内的增量合并，窗口到期后的下一个增量触发发出"""
+    coalescer = _DeltaCoalescer(window=0.02, max_chars=256)
+    assert coalescer.push(EV_CONTENT, None, "a") == []
+    clock[0] += 0.015
+    assert coalescer.push(EV_CONTENT, None, "b") == []
+    assert coalescer.time_left() == pytest.approx(0.005)
+    clock[0] += 0.015
+    assert coalescer.push(EV_CONTENT, None, "c") == [(EV_CONTENT, None, "abc")]
+    assert coalescer.time_left() is None
+
+
+def test_coalescer_flushes_at_max_chars(clock):
+    """缓冲文本达到 max_chars 时立即发出"""
+    coalescer = _DeltaCoalescer(window=60, max_chars=4)
+    assert coalescer.push(EV_CONTENT, None, "ab") == []
+    assert coalescer.push(EV_CONTENT, None, "cd") == [(EV_CONTENT, None, "abcd")]
+    assert coalescer.push(EV_CONTENT, None, "efghij") == [(EV_CONTENT, None, "efghij")]
+    assert coalescer.flush() is None
+
+
+def test_coalescer_preserves_order_across_event_types(clock):
+    """增量类型或所属块变化时先发出之前的缓冲，批次顺序与到达顺序一致"""
+    coalescer = _DeltaCoalescer(window=60, max_chars=256)
+    batches = []
+    for event_type, block_id, text in [
+        (EV_CONTENT, None, "正"),
+        (EV_CONTENT, None, "文"),
+        (EV_THINKING, "t1", "思"),
+        (EV_THINKING, "t1", "考"),
+        (EV_THINKING, "t2", "再想"),
+        (EV_CONTENT, None, "结尾"),
+    ]:
+        batches.extend(coalescer.push(event_type, block_id, text))
+    batches.append(coalescer.flush())
+
+    assert batches == [
+        (EV_CONTENT, None, "正文"),
+        (EV_THINKING, "t1", "思考"),
+        (EV_THINKING, "t2", "再想"),
+        (EV_CONTENT, None, "结尾"),
+    ]
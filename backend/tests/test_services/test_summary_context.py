@@ -0,0 +1,129 @@
+"""测试会话摘要相关的纯逻辑（不依赖数据库）：token 估算、从历史中取出摘要、后台摘要任务去重"""
+
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+from uuid import uuid4
+
+import pytest
+
+from app.services import chat_service as chat_service_module
+from app.services.chat_service import ChatService, _estimate_tokens
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("", 0),
+    ("abcd", 1),
+    ("abcde", 2),  # 其余文本约 4 字符/token，向上取整
+    ("hello world", 3),
+    ("你好", 2),  # 中日韩字符约 1 token/字
+    ("こんにちは", 5),
+    ("한국어", 3),
+    ("中文 text", 4),  # 2 个中文字符 + 5 个其他字符
+    ("你好，世界！", 5),  # 全角标点不计入中日韩字符：4 + ceil(2 / 4)
+])
+def test_estimate_tokens(text, expected):
+    """中日韩字符和其他文本分开估算"""
+    assert _estimate_tokens(text) == expected
+
+
+def _row(role, content, is_summary=False, is_internal=False):
+    """构造 _LLM_CONTEXT_COLUMNS 形状的查询结果行"""
+    return SimpleNamespace(
+        role=role,
+        content=content,
+        tool_calls=None,
+        tool_call_id=None,
+        name=None,
+        is_internal=is_internal,
+        is_summary=is_summary,
+    )
+
+
+def test_load_llm_context_puts_latest_summary_first():
+    """历史中有多条摘要时只取最新的一条放在开头，摘要行本身不作为普通消息"""
+    rows = [
+        _row("system", "【对话摘要】旧摘要", is_summary=True),
+        _row("system", "【对话摘要】新摘要", is_summary=True),
+        _row("user", "问题1"),
+        _row("assistant", "思考过程", is_internal=True),
+        _row("assistant", "回答1"),
+        _row("user", "问题2"),  # 本轮用户消息已提前写入
+    ]
+    db = MagicMock()
+    db.query.return_value.filter.return_value.order_by.return_value.all.return_value = rows
+
+    messages = ChatService(db)._load_llm_context(str(uuid4()), "问题2", skip_user_message=True)
+
+    assert messages == [
+        {"role": "system", "content": "【对话摘要】新摘要"},
+        {"role": "user", "content": "问题1"},
+        {"role": "assistant", "content": "回答1"},
+        {"role": "user", "content": "问题2"},
+    ]
+
+
+def test_load_llm_context_without_summary():
+    """没有摘要时不插入 system 消息"""
+    db = MagicMock()
+    db.query.return_value.filter.return_value.order_by.return_value.all.return_value = [
+        _row("user", "问题1"),
+        _row("assistant", "回答1"),
+        _row("user", "问题2"),
+    ]
+
+    messages = ChatService(db)._load_llm_context(str(uuid4()), "问题2", skip_user_message=True)
+
+    assert [msg["role"] for msg in messages] == ["user", "assistant", "user"]
+
+
+@pytest.fixture
+def fake_summary():
+    """替换数据库会话和摘要生成：摘要任务在 release 被设置前一直处于进行中"""
+    release = asyncio.Event()
+
+    async def generate(session_id, user):
+        await release.wait()
+
+    generate_mock = AsyncMock(side_effect=generate)
+    with patch.object(chat_service_module, "SESSION_LOCAL", MagicMock()), \
+            patch.object(ChatService, "generate_session_summary", generate_mock):
+        yield release, generate_mock
+
+
+@pytest.mark.asyncio
+async def test_summary_in_flight_dedup(fake_summary):
+    """同一会话的摘要任务完成前不会重复启动，完成后可以再次启动"""
+    release, generate_mock = fake_summary
+    session_id = str(uuid4())
+
+    assert chat_service_module._schedule_session_summary(session_id, 1)
+    assert not chat_service_module._schedule_session_summary(session_id, 1)
+    assert chat_service_module._schedule_session_summary(str(uuid4()), 1)  # 其他会话不受影响
+
+    release.set()
+    await asyncio.gather(*list(chat_service_module._BACKGROUND_TASKS))
+
+    assert generate_mock.await_count == 2
+    assert session_id not in chat_service_module._SUMMARY_IN_FLIGHT
+
+    assert chat_service_module._schedule_session_summary(session_id, 1)
+    await asyncio.gather(*list(chat_service_module._BACKGROUND_TASKS))
+    assert generate_mock.await_count == 3
+
+
+@pytest.mark.asyncio
+async def test_schedule_summary_only_over_threshold(fake_summary):
+    """上下文未达到 90% 阈值时不触发摘要"""
+    release, generate_mock = fake_summary
+    release.set()
+    service = ChatService(MagicMock())
+
+    below = SimpleNamespace(session_id=uuid4(), user_id=1, current_context_tokens=899)
+    assert not service._schedule_summary_if_needed(below, 1000)
+
+    over = SimpleNamespace(session_id=uuid4(), user_id=1, current_context_tokens=900)
+    assert service._schedule_summary_if_needed(over, 1000)
+    await asyncio.gather(*list(chat_service_module._BACKGROUND_TASKS))
+
+    assert generate_mock.await_count == 1